@@ -4,11 +4,22 @@ import pysam
 import pyranges as pr
 import argparse
 import numpy as np
+import pandas as pd
 import os
 import warnings
+from itertools import islice
+from multiprocessing import Pool
+
+try:
+    import pyBigWig
+except ImportError:
+    pyBigWig = None
 
 warnings.filterwarnings("ignore")
 
+# reads are turned into cut sites this many at a time
+CUT_SITE_BLOCK_SIZE = 1 << 16
+
 logging.basicConfig(
     format="%(asctime)s %(levelname)-8s %(message)s",
     level=logging.INFO,
@@ -23,17 +34,136 @@ def parse_args():
 
     # Required parameters
     parser.add_argument("--bam_file", type=str, default=None)
-    parser.add_argument("--peak_file", type=str, default=None)
+    parser.add_argument("--peak_file", type=str, default=None,
+                        help="Regions to make the signal for. With --genome_wide the genome wide "
+                        "signal is masked to these regions, if given.")
+    parser.add_argument("--genome_wide", action="store_true",
+                        help="Read the BAM file once per chromosome and make the signal of the whole "
+                        "chromosome, instead of fetching the reads of every region")
     parser.add_argument("--extend_size", type=int, default=0)
     parser.add_argument("--forward_shift", type=int, default=4)
     parser.add_argument("--reverse_shift", type=int, default=-4)
     parser.add_argument("--out_dir", type=str, default=None)
     parser.add_argument("--out_name", type=str, default=None)
     parser.add_argument("--chrom_size_file", type=str, default=None)
+    parser.add_argument("--processes", "--threads", type=int, default=1,
+                        help="Number of processes. Each one reads its own handle of the indexed BAM "
+                        "file: a chromosome (--genome_wide) or a group of regions at a time.")
+    parser.add_argument("--group_file", type=str, default=None,
+                        help="CSV file with the columns barcode and group. Makes one BigWig file "
+                        "{out_name}_{group}.bw per group from one pass per chromosome (as --genome_wide, "
+                        "masked to --peak_file if given).")
+    parser.add_argument("--bc_tag", type=str, default="CB",
+                        help="BAM tag of the cell barcode, for --group_file")
+    parser.add_argument("--normalize", type=str, default="none",
+                        choices=["none", "cpm", "rip"],
+                        help="Scaling of the group signals (--group_file): counts per million cut sites "
+                        "of the group (cpm) or per million cut sites of the group in the peaks (rip)")
+    parser.add_argument("--writer", type=str, default="auto",
+                        choices=["auto", "pybigwig", "wigtobigwig"],
+                        help="How to write the BigWig file: directly with pyBigWig, or as a "
+                        "wig file converted by wigToBigWig. auto uses pyBigWig if installed.")
 
     return parser.parse_args()
 
 
+def read_chrom_sizes(chrom_size_file: str) -> list:
+    """
+    Read a chromosome size file (chromosome name and length per line) into a
+    list of (chrom, size) in file order
+    """
+    chrom_sizes = []
+    with open(chrom_size_file) as f:
+        for line in f:
+            fields = line.split()
+            if fields:
+                chrom_sizes.append((fields[0], int(fields[1])))
+
+    return chrom_sizes
+
+
+class BigWigWriter:
+    """
+    Write signal arrays straight into a BigWig file with pyBigWig, which
+    bins the values and builds the zoom levels itself. Signals must be added
+    in the order of chrom_sizes and by increasing start.
+    """
+
+    def __init__(self, bw_filename: str, chrom_sizes: list):
+        self.bw = pyBigWig.open(bw_filename, "w")
+        self.bw.addHeader(chrom_sizes)
+
+    def add(self, chrom: str, start: int, signal: np.array):
+        if len(signal):
+            self.bw.addEntries(chrom, int(start), values=signal.astype(np.float64).tolist(), span=1, step=1)
+
+    def add_runs(self, chrom: str, starts: np.array, ends: np.array, values: np.array):
+        if len(starts):
+            self.bw.addEntries([chrom] * len(starts), starts.tolist(), ends=ends.tolist(),
+                               values=values.astype(np.float64).tolist())
+
+    def close(self):
+        self.bw.close()
+
+
+class WigToBigWigWriter:
+    """
+    Write signal arrays to a fixedStep wig file and convert it with the UCSC
+    wigToBigWig binary on close
+    """
+
+    def __init__(self, bw_filename: str, chrom_size_file: str):
+        self.bw_filename = bw_filename
+        self.chrom_size_file = chrom_size_file
+        self.wig_filename = os.path.splitext(bw_filename)[0] + ".wig"
+        self.f = open(self.wig_filename, "w")
+
+    def add(self, chrom: str, start: int, signal: np.array):
+        self.f.write(f"fixedStep chrom={chrom} start={start+1} step=1\n")
+        self.f.write("\n".join(map(str, signal.tolist())))
+        self.f.write("\n")
+
+    def add_runs(self, chrom: str, starts: np.array, ends: np.array, values: np.array):
+        for start, end, value in zip(starts.tolist(), ends.tolist(), values.tolist()):
+            self.f.write(f"fixedStep chrom={chrom} start={start+1} step={end-start} span={end-start}\n{value}\n")
+
+    def close(self):
+        self.f.close()
+        logging.info("Conveting wig to bigwig!")
+        sp.run(["wigToBigWig", self.wig_filename, self.chrom_size_file, self.bw_filename])
+        os.remove(self.wig_filename)
+
+
+def open_writer(bw_filename: str, chrom_size_file: str, writer: str = "auto"):
+    """
+    Open a BigWig writer: BigWigWriter if pyBigWig is installed (or asked
+    for), else WigToBigWigWriter
+    """
+    if writer == "pybigwig" or (writer == "auto" and pyBigWig is not None):
+        if pyBigWig is None:
+            raise ImportError("pyBigWig is not installed")
+        return BigWigWriter(bw_filename, read_chrom_sizes(chrom_size_file))
+
+    return WigToBigWigWriter(bw_filename, chrom_size_file)
+
+
+def regions_by_chrom(grs: pr.PyRanges, chrom_sizes: list) -> list:
+    """
+    (chrom, start, end) of the regions in the order of chrom_sizes and by
+    start, the order BigWig files need. Regions on chromosomes missing from
+    chrom_sizes are left out.
+    """
+    regions = {}
+    for chrom, start, end in zip(grs.Chromosome, grs.Start, grs.End):
+        regions.setdefault(chrom, []).append((chrom, int(start), int(end)))
+
+    missing = set(regions) - set(chrom for chrom, _ in chrom_sizes)
+    if missing:
+        logging.warning(f"Skipping regions on chromosomes without size: {', '.join(sorted(missing))}")
+
+    return [region for chrom, _ in chrom_sizes for region in sorted(regions.get(chrom, []))]
+
+
 def get_count(
     chrom: str = None,
     start: int = None,
@@ -58,57 +188,393 @@ def get_count(
         BAM file
     """
 
-    signal = np.zeros(shape=(end - start))
+    length = end - start
+    diff = np.zeros(shape=(length + 1), dtype=np.int64)
+    for cut_sites in get_cut_sites(bam.fetch(reference=chrom, start=start, end=end),
+                                   forward_shift, reverse_shift):
+        add_cut_sites(diff, cut_sites - start, length, extend_size)
+
+    return np.cumsum(diff[:-1]).astype(np.float64)
+
+
+def get_cut_sites(reads, forward_shift: int, reverse_shift: int, block_size: int = CUT_SITE_BLOCK_SIZE):
+    """
+    Tn5 cut sites of reads: the shifted end of reverse reads and the shifted
+    start of forward reads. Yields arrays of the cut sites of block_size reads
+    at a time.
+    """
+    reads = iter(reads)
+    while True:
+        cut_sites = np.fromiter((read.reference_end + reverse_shift if read.is_reverse
+                                 else read.reference_start + forward_shift
+                                 for read in islice(reads, block_size)), dtype=np.int64)
+        if not len(cut_sites):
+            return
+        yield cut_sites
+
+
+def add_cut_sites(diff: np.array, cut_sites: np.array, length: int, extend_size: int):
+    """
+    Add the cut sites within [0, length) to the difference array diff (of
+    length + 1): +1 at the start and -1 at the end of every cut site, or of its
+    window of +/- extend_size clipped to [0, length); an extend_size of 0 or
+    less counts the cut site alone. The counts are made with bincount over the
+    span of the cut sites only, which is short for the reads of a coordinate
+    sorted block.
+    """
+    cut_sites = cut_sites[(0 <= cut_sites) & (cut_sites < length)]
+    if not len(cut_sites):
+        return
+
+    extend_size = max(extend_size, 0)
+    lo = np.maximum(cut_sites - extend_size, 0)
+    hi = np.minimum(cut_sites + max(extend_size, 1), length)
+    for positions, sign in ((lo, 1), (hi, -1)):
+        offset = positions.min()
+        counts = np.bincount(positions - offset)
+        diff[offset:offset + len(counts)] += sign * counts
+
+
+def chrom_signal(
+    chrom: str = None,
+    length: int = None,
+    forward_shift: int = None,
+    reverse_shift: int = None,
+    extend_size: int = 0,
+    bam: pysam.Samfile = None,
+) -> np.array:
+    """
+    Get Tn5 cutting count of a whole chromosome from one pass over its reads.
+    Every cut site (or its window of +/- extend_size) adds one to a difference
+    array, whose cumulative sum is the signal.
+
+    Parameters
+    ----------
+    chrom : str
+        Chromosome name
+    length : int
+        Chromosome length
+    bam : pysam.Samfile
+        BAM file
+    """
+
+    diff = np.zeros(shape=(length + 1), dtype=np.int32)
+    for cut_sites in get_cut_sites(bam.fetch(reference=chrom), forward_shift, reverse_shift):
+        add_cut_sites(diff, cut_sites, length, extend_size)
+
+    return np.cumsum(diff[:-1], dtype=np.int32)
+
+
+def cut_site_signal(cut_sites: np.array, length: int, extend_size: int) -> np.array:
+    """
+    Signal of cut sites within [0, length): one for every cut site, or for its
+    window of +/- extend_size clipped to the chromosome
+    """
+    diff = np.zeros(shape=(length + 1), dtype=np.int32)
+    add_cut_sites(diff, cut_sites, length, extend_size)
+
+    return np.cumsum(diff[:-1], dtype=np.int32)
+
+
+def get_grouped_cut_sites(reads, forward_shift: int, reverse_shift: int, barcode_groups: dict,
+                          bc_tag: str, block_size: int = CUT_SITE_BLOCK_SIZE):
+    """
+    Tn5 cut sites (see get_cut_sites) and group codes of the reads whose
+    barcode tag is in barcode_groups, as two arrays. The reads are collected
+    block_size at a time.
+    """
+    blocks = []
+    cut_sites, groups = [], []
+    for read in reads:
+        if not read.has_tag(bc_tag):
+            continue
+        group = barcode_groups.get(read.get_tag(bc_tag))
+        if group is None:
+            continue
 
-    for read in bam.fetch(reference=chrom, start=start, end=end):
-        # cut counts
         if read.is_reverse:
-            cut_site = read.reference_end + reverse_shift
+            cut_sites.append(read.reference_end + reverse_shift)
         else:
-            cut_site = read.reference_start + forward_shift
+            cut_sites.append(read.reference_start + forward_shift)
+        groups.append(group)
+        if len(cut_sites) == block_size:
+            blocks.append((np.array(cut_sites, dtype=np.int64), np.array(groups, dtype=np.int64)))
+            cut_sites, groups = [], []
+    blocks.append((np.array(cut_sites, dtype=np.int64), np.array(groups, dtype=np.int64)))
+
+    return np.concatenate([c for c, _ in blocks]), np.concatenate([g for _, g in blocks])
+
+
+def signal_runs(signal: np.array):
+    """
+    Starts, ends and values of the runs of equal non-zero values of a signal
+    """
+    change = np.flatnonzero(np.diff(signal)) + 1
+    starts = np.concatenate(([0], change))
+    ends = np.concatenate((change, [len(signal)]))
+    values = signal[starts]
+    nonzero = values != 0
+
+    return starts[nonzero], ends[nonzero], values[nonzero]
+
+
+def count_regions(bam_file: str, regions: list, forward_shift: int, reverse_shift: int,
+                  extend_size: int) -> list:
+    """
+    get_count of every region (chrom, start, end), with an own handle of the
+    BAM file
+    """
+    bam = pysam.Samfile(bam_file, "rb")
+    signals = [get_count(chrom=chrom, start=start, end=end,
+                         forward_shift=forward_shift,
+                         reverse_shift=reverse_shift,
+                         extend_size=extend_size,
+                         bam=bam) for chrom, start, end in regions]
+    bam.close()
+
+    return signals
+
+
+def count_chrom(bam_file: str, chrom: str, length: int, regions: list, forward_shift: int,
+                reverse_shift: int, extend_size: int):
+    """
+    chrom_signal of a chromosome, with an own handle of the BAM file. Returns
+    the runs of the signal, or the signal of every region (start, end) if
+    regions is given. Unlike get_count, the windows of cut sites outside a
+    region add to the region.
+    """
+    logging.info(f"Counting cut sites on {chrom}")
+    bam = pysam.Samfile(bam_file, "rb")
+    signal = chrom_signal(chrom=chrom, length=length,
+                          forward_shift=forward_shift,
+                          reverse_shift=reverse_shift,
+                          extend_size=extend_size,
+                          bam=bam)
+    bam.close()
+
+    if regions is None:
+        return signal_runs(signal)
+    return [signal[start:end] for start, end in regions]
+
+
+def count_chrom_groups(bam_file: str, chrom: str, length: int, regions: list, forward_shift: int,
+                       reverse_shift: int, extend_size: int, barcode_groups: dict, bc_tag: str,
+                       n_groups: int):
+    """
+    count_chrom of every group of barcodes, from one pass over the reads of
+    the chromosome. Returns the list of the results of the groups, the number
+    of cut sites of every group and the number of them in the regions.
+    """
+    logging.info(f"Counting cut sites on {chrom}")
+    bam = pysam.Samfile(bam_file, "rb")
+    cut_sites, groups = get_grouped_cut_sites(bam.fetch(reference=chrom), forward_shift, reverse_shift,
+                                              barcode_groups, bc_tag)
+    bam.close()
+
+    inside = (0 <= cut_sites) & (cut_sites < length)
+    cut_sites, groups = cut_sites[inside], groups[inside]
+    n_cut_sites = np.bincount(groups, minlength=n_groups)
+
+    n_in_regions = np.zeros(n_groups, dtype=np.int64)
+    if regions is not None:
+        starts, ends = np.array(regions, dtype=np.int64).reshape(-1, 2).T
+        # regions are merged and sorted, so a cut site can only be in the last one starting before it
+        i = np.searchsorted(starts, cut_sites, side="right") - 1
+        in_region = (i >= 0) & (cut_sites < ends[np.maximum(i, 0)])
+        n_in_regions = np.bincount(groups[in_region], minlength=n_groups)
+
+    results = []
+    order = np.argsort(groups, kind="stable")
+    bounds = np.searchsorted(groups[order], np.arange(n_groups + 1))
+    for group in range(n_groups):
+        signal = cut_site_signal(cut_sites[order[bounds[group]:bounds[group + 1]]], length, extend_size)
+        if regions is None:
+            results.append(signal_runs(signal))
+        else:
+            # copies, so that the chromosome signal is not kept alive by views
+            results.append([signal[start:end].copy() for start, end in regions])
+
+    return results, n_cut_sites, n_in_regions
+
+
+def partial_regions(args):
+    """count_regions for Pool.imap."""
+    return count_regions(*args)
 
-        if start <= cut_site < end:
-            if extend_size > 0:
-                _start = max(0, cut_site - start - extend_size)
-                _end = min(cut_site - start + extend_size, end)
-                signal[_start: _end] += 1
+
+def partial_chrom(args):
+    """count_chrom for Pool.imap."""
+    return count_chrom(*args)
+
+
+def partial_chrom_groups(args):
+    """count_chrom_groups for Pool.imap."""
+    return count_chrom_groups(*args)
+
+
+def region_groups(regions: list, n_groups: int, max_bases: int = 1 << 22) -> list:
+    """
+    Split regions into consecutive groups of about the same number of bases:
+    n_groups groups, or more to keep the signals of a group below max_bases
+    """
+    if not regions:
+        return []
+
+    ends = np.cumsum([end - start for _, start, end in regions])
+    n_groups = max(n_groups, -(-int(ends[-1]) // max_bases))
+    bounds = np.searchsorted(ends, ends[-1] * np.arange(1, n_groups) / n_groups, side="right")
+    bounds = [0] + sorted(set(bounds.tolist()) - {0, len(regions)}) + [len(regions)]
+
+    return [regions[i:j] for i, j in zip(bounds[:-1], bounds[1:])]
+
+
+def genome_wide_chroms(bam_file: str, chrom_sizes: list, regions: list, masked: bool):
+    """
+    The (chrom, length) of chrom_sizes to count in the genome wide mode: the
+    ones in the BAM file, and with regions if masked. Also returns the
+    regions (start, end) of every chromosome.
+    """
+    chrom_regions = {}
+    for chrom, start, end in regions:
+        chrom_regions.setdefault(chrom, []).append((start, end))
+
+    with pysam.Samfile(bam_file, "rb") as bam:
+        references = set(bam.references)
+    chrom_sizes = [(chrom, length) for chrom, length in chrom_sizes
+                   if chrom in references and (not masked or chrom in chrom_regions)]
+
+    return chrom_sizes, chrom_regions
+
+
+def write_group_signals(bam_file: str, bw_prefix: str, chrom_size_file: str, grs: pr.PyRanges,
+                        barcode_groups: dict, group_names: list, bc_tag: str, normalize: str,
+                        processes: int, writer: str, forward_shift: int, reverse_shift: int,
+                        extend_size: int):
+    """
+    Count the signal of every group of barcodes genome wide, or masked to the
+    regions of grs if given, and write it to {bw_prefix}_{group}.bw. The
+    chromosomes are counted (in a pool of processes) before anything is
+    written, as the scaling of a group depends on all its cut sites.
+    """
+    if normalize == "rip" and grs is None:
+        raise ValueError("Reads in peaks normalization needs a peak file")
+
+    chrom_sizes = read_chrom_sizes(chrom_size_file)
+    regions = [] if grs is None else regions_by_chrom(grs, chrom_sizes)
+    chrom_sizes, chrom_regions = genome_wide_chroms(bam_file, chrom_sizes, regions, grs is not None)
+    jobs = [(bam_file, chrom, length, chrom_regions.get(chrom), forward_shift, reverse_shift, extend_size,
+             barcode_groups, bc_tag, len(group_names)) for chrom, length in chrom_sizes]
+
+    if processes > 1:
+        with Pool(processes) as pool:
+            results = pool.map(partial_chrom_groups, jobs)
+    else:
+        results = list(map(partial_chrom_groups, jobs))
+
+    n_cut_sites = sum((n for _, n, _ in results), np.zeros(len(group_names), dtype=np.int64))
+    n_in_regions = sum((n for _, _, n in results), np.zeros(len(group_names), dtype=np.int64))
+    if normalize == "none":
+        scales = np.ones(len(group_names))
+    else:
+        totals = n_cut_sites if normalize == "cpm" else n_in_regions
+        scales = np.divide(1e6, totals, out=np.zeros(len(group_names)), where=totals > 0)
+
+    for group, name in enumerate(group_names):
+        in_peaks = "" if grs is None else f", {n_in_regions[group]} in peaks"
+        logging.info(f"Writing group {name}: {n_cut_sites[group]} cut sites{in_peaks}, "
+                     f"scaled by {scales[group]:.6g}")
+        group_writer = open_writer(f"{bw_prefix}_{name}.bw", chrom_size_file, writer)
+        for (chrom, _), (group_results, _, _) in zip(chrom_sizes, results):
+            if grs is None:
+                starts, ends, values = group_results[group]
+                group_writer.add_runs(chrom, starts, ends, values * scales[group])
             else:
-                signal[cut_site - start] += 1
+                for (start, end), signal in zip(chrom_regions[chrom], group_results[group]):
+                    group_writer.add(chrom, start, signal * scales[group])
+        group_writer.close()
+
+
+def write_signal(bam_file: str, writer, chrom_sizes: list, grs: pr.PyRanges, genome_wide: bool,
+                 processes: int, forward_shift: int, reverse_shift: int, extend_size: int):
+    """
+    Count the signal of the regions of grs, or of every chromosome of
+    chrom_sizes that is in the BAM file if genome_wide, in a pool of
+    processes and write it in the order of chrom_sizes
+    """
+    regions = [] if grs is None else regions_by_chrom(grs, chrom_sizes)
+
+    if genome_wide:
+        chrom_sizes, chrom_regions = genome_wide_chroms(bam_file, chrom_sizes, regions, grs is not None)
+        jobs = [(bam_file, chrom, length, chrom_regions.get(chrom), forward_shift, reverse_shift, extend_size)
+                for chrom, length in chrom_sizes]
+        count, keys = partial_chrom, [chrom for chrom, _ in chrom_sizes]
+    else:
+        groups = region_groups(regions, 4 * processes if processes > 1 else 1)
+        jobs = [(bam_file, group, forward_shift, reverse_shift, extend_size) for group in groups]
+        count, keys = partial_regions, groups
+
+    pool = Pool(processes) if processes > 1 else None
+    results = pool.imap(count, jobs) if pool else map(count, jobs)
 
-    return signal
+    # results come in the order of the jobs, so in the order of chrom_sizes
+    for key, result in zip(keys, results):
+        if genome_wide and grs is None:
+            writer.add_runs(key, *result)
+        elif genome_wide:
+            for (start, end), signal in zip(chrom_regions[key], result):
+                writer.add(key, start, signal)
+        else:
+            for (chrom, start, end), signal in zip(key, result):
+                writer.add(chrom, start, signal)
+
+    if pool:
+        pool.close()
+        pool.join()
 
 
 def main():
     args = parse_args()
+    if args.peak_file is None and not args.genome_wide and args.group_file is None:
+        raise ValueError("--peak_file is needed without --genome_wide")
+    if args.normalize != "none" and args.group_file is None:
+        raise ValueError("--normalize is only supported with --group_file")
 
-    bam = pysam.Samfile(args.bam_file, "rb")
+    bw_filename = os.path.join(args.out_dir, "{}.bw".format(args.out_name))
+    chrom_sizes = read_chrom_sizes(args.chrom_size_file)
 
-    logging.info(f"Loading genomic regions from {args.peak_file}")
-    grs = pr.read_bed(args.peak_file)
-    grs = grs.merge()
+    grs = None
+    if args.peak_file is not None:
+        logging.info(f"Loading genomic regions from {args.peak_file}")
+        grs = pr.read_bed(args.peak_file)
+        grs = grs.merge()
 
-    logging.info(f"Total of {len(grs)} regions")
+        logging.info(f"Total of {len(grs)} regions")
 
-    wig_filename = os.path.join(args.out_dir, "{}.wig".format(args.out_name))
-    bw_filename = os.path.join(args.out_dir, "{}.bw".format(args.out_name))
+    if args.group_file is not None:
+        logging.info(f"Loading barcode groups from {args.group_file}")
+        df = pd.read_csv(args.group_file, dtype=str)
+        codes, group_names = pd.factorize(df["group"])
+        barcode_groups = dict(zip(df["barcode"], codes.tolist()))
+        logging.info(f"Total of {len(barcode_groups)} barcodes in {len(group_names)} groups")
 
-    # Open a new bigwig file for writing
-    with open(wig_filename, "w") as f:
-        for chrom, start, end in zip(grs.Chromosome, grs.Start, grs.End):
-            signal = get_count(chrom=chrom, start=start, end=end,
-                               forward_shift=args.forward_shift, 
-                               reverse_shift=args.reverse_shift,
-                               extend_size=args.extend_size,
-                               bam=bam)
-
-            f.write(f"fixedStep chrom={chrom} start={start+1} step=1\n")
-            f.write("\n".join(str(e) for e in signal))
-            f.write("\n")
-
-    # convert to bigwig file
-    logging.info("Conveting wig to bigwig!")
-    sp.run(["wigToBigWig", wig_filename, args.chrom_size_file, bw_filename])
-    os.remove(wig_filename)
+        write_group_signals(args.bam_file, os.path.join(args.out_dir, args.out_name),
+                            args.chrom_size_file, grs, barcode_groups, list(group_names),
+                            bc_tag=args.bc_tag,
+                            normalize=args.normalize,
+                            processes=args.processes,
+                            writer=args.writer,
+                            forward_shift=args.forward_shift,
+                            reverse_shift=args.reverse_shift,
+                            extend_size=args.extend_size)
+    else:
+        writer = open_writer(bw_filename, args.chrom_size_file, args.writer)
+        write_signal(args.bam_file, writer, chrom_sizes, grs,
+                     genome_wide=args.genome_wide,
+                     processes=args.processes,
+                     forward_shift=args.forward_shift,
+                     reverse_shift=args.reverse_shift,
+                     extend_size=args.extend_size)
+        writer.close()
     logging.info("Done!")
 
 
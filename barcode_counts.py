@@ -0,0 +1,76 @@
+"""
+Per-cell-barcode species counts, collected while reads are classified.
+
+The table has the same layout as the one separate_barcodes.py builds from the
+read-name lists: one row per barcode (sorted) and one integer column per class
+(sorted), so it can replace that extra pass.
+"""
+
+from array import array
+
+
+def barcode_from_qname(qname):
+    """
+    Get the cell barcode from a SHARE-seq read name, e.g. 'A00123:...:1234_AAC,GTA,TTG'
+    gives 'AACGTATTG' (the same barcode as separate_barcodes.py), or None if
+    the read name does not have that layout
+    """
+    try:
+        names = qname.split('_')[1].split(',')
+        return names[0] + names[1] + names[2]
+    except IndexError:
+        return None
+
+
+def get_barcode_function(barcode_source):
+    """
+    Return a function that gets the barcode of a read, from its name if
+    barcode_source is 'qname' or else from the BAM tag barcode_source. The
+    function returns None for reads without barcode.
+    """
+    if barcode_source == 'qname':
+        return lambda read: barcode_from_qname(read.query_name)
+
+    def barcode_from_tag(read):
+        try:
+            return read.get_tag(barcode_source)
+        except KeyError:
+            return None
+
+    return barcode_from_tag
+
+
+class BarcodeSpeciesCounts:
+    """
+    Count reads per barcode and class in one flat array of unsigned 64-bit
+    integers; every barcode gets a row of len(classes) counters.
+    """
+
+    def __init__(self, classes=('human', 'mouse', 'ambiguous')):
+        self.classes = tuple(classes)
+        self.rows = {}
+        self.counts = array('Q')
+
+    def add(self, barcode, class_index, n=1):
+        row = self.rows.get(barcode)
+        if row is None:
+            row = self.rows[barcode] = len(self.rows)
+            self.counts.extend([0] * len(self.classes))
+        self.counts[row * len(self.classes) + class_index] += n
+
+    def update(self, other):
+        """Add the counts of another table with the same classes."""
+        width = len(self.classes)
+        for barcode, row in other.rows.items():
+            for i, n in enumerate(other.counts[row * width:(row + 1) * width]):
+                if n:
+                    self.add(barcode, i, n)
+
+    def write(self, filename):
+        width = len(self.classes)
+        columns = sorted(range(width), key=lambda i: self.classes[i])
+        with open(filename, 'w') as f:
+            f.write(','.join(['barcode'] + [self.classes[i] for i in columns]) + '\n')
+            for barcode in sorted(self.rows):
+                row = self.rows[barcode] * width
+                f.write(','.join([barcode] + [str(self.counts[row + i]) for i in columns]) + '\n')
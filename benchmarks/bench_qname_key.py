@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+"""
+Benchmark the qname comparison used by the disambiguate.py merge loop.
+
+Two name sorted lists of synthetic SHARE-seq read names (with multimappers and
+reads that only aligned to one species) are walked the way main() walks the two
+BAM files: once with the previous nat_cmp()/read_next_reads() implementation,
+which re-splits both names on every comparison, and once with merge_groups(),
+which builds one qname_key() per qname. Both walks must produce the same groups.
+The sort order of qname_key() is also checked against a port of samtools'
+strnum_cmp().
+
+Example:
+python benchmarks/bench_qname_key.py --reads 1000000
+"""
+
+import argparse
+import functools
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from disambiguate import merge_groups, qname_key  # noqa: E402
+
+
+class Read(object):
+    """Stand-in for pysam.AlignedSegment, only the name is needed here."""
+
+    __slots__ = ("qname", "query_name")
+
+    def __init__(self, name):
+        self.qname = self.query_name = name
+
+
+def legacy_nat_cmp(a, b):
+    convert = lambda text: int(text) if text.isdigit() else text
+    alphanum_key = lambda key: [convert(c) for c in re.split('([0-9]+)', key)]
+    return (alphanum_key(a) > alphanum_key(b)) - (alphanum_key(a) < alphanum_key(b))
+
+
+def legacy_read_next_reads(fileobject, listobject):
+    while True:
+        try:
+            myRead = next(fileobject)
+        except StopIteration:
+            return None
+        if legacy_nat_cmp(myRead.qname, listobject[0].qname) == 0:
+            listobject.append(myRead)
+        else:
+            return myRead
+
+
+def legacy_merge(humanreads, mousereads):
+    """The grouping done by the previous main() loop, without the BAM writing."""
+    humanfile, mousefile = iter(humanreads), iter(mousereads)
+    nexthumread, nextmouread = next(humanfile), next(mousefile)
+    groups = []
+    EOFhuman = EOFmouse = False
+    while not (EOFhuman or EOFmouse):
+        order = legacy_nat_cmp(nexthumread.qname, nextmouread.qname)
+        if order > 0:
+            mylist = [nextmouread]
+            nextmouread = legacy_read_next_reads(mousefile, mylist)
+            EOFmouse = nextmouread is None
+            groups.append(([], mylist))
+        elif order < 0:
+            mylist = [nexthumread]
+            nexthumread = legacy_read_next_reads(humanfile, mylist)
+            EOFhuman = nexthumread is None
+            groups.append((mylist, []))
+        else:
+            humlist, moulist = [nexthumread], [nextmouread]
+            nexthumread = legacy_read_next_reads(humanfile, humlist)
+            nextmouread = legacy_read_next_reads(mousefile, moulist)
+            EOFhuman, EOFmouse = nexthumread is None, nextmouread is None
+            groups.append((humlist, moulist))
+    # the rest of the other file was flushed without natural comparisons
+    if not EOFhuman:
+        rest, myRead, is_human = humanfile, nexthumread, True
+    elif not EOFmouse:
+        rest, myRead, is_human = mousefile, nextmouread, False
+    else:
+        return groups
+    for read in [myRead] + list(rest):
+        if groups and read.qname == (groups[-1][0] or groups[-1][1])[0].qname:
+            (groups[-1][0] or groups[-1][1]).append(read)
+        else:
+            groups.append(([read], []) if is_human else ([], [read]))
+    return groups
+
+
+def strnum_cmp(a, b):
+    """Python port of strnum_cmp() from samtools bam_sort.c."""
+    a, b = a.encode() + b'\0', b.encode() + b'\0'
+    i = j = 0
+    isdigit = lambda c: 48 <= c <= 57
+    while a[i] and b[j]:
+        if not isdigit(a[i]) or not isdigit(b[j]):
+            if a[i] != b[j]:
+                return a[i] - b[j]
+            i += 1
+            j += 1
+        else:
+            while a[i] == 48:
+                i += 1
+            while b[j] == 48:
+                j += 1
+            while isdigit(a[i]) and a[i] == b[j]:
+                i += 1
+                j += 1
+            diff = a[i] - b[j]
+            while isdigit(a[i]) and isdigit(b[j]):
+                i += 1
+                j += 1
+            if isdigit(a[i]):
+                return 1
+            elif isdigit(b[j]):
+                return -1
+            elif diff:
+                return diff
+    return 1 if a[i] else -1 if b[j] else 0
+
+
+def make_reads(n_reads, seed):
+    rng = random.Random(seed)
+    barcodes = ["".join(rng.choice("ACGT") for _ in range(8)) for _ in range(96)]
+    names = set()
+    while len(names) < n_reads // 2:
+        names.add("A00%d:%d:HXXXXXXX:%d:%d:%d:%d_%s,%s,%s" % (
+            rng.randint(1, 9), rng.randint(1, 999), rng.randint(1, 4),
+            rng.randint(1101, 2678), rng.randint(1, 40000), rng.randint(1, 40000),
+            rng.choice(barcodes), rng.choice(barcodes), rng.choice(barcodes)))
+    names = sorted(names, key=qname_key)
+    human, mouse = [], []
+    for name in names:
+        copies = 2 if rng.random() < 0.1 else 1  # multimappers
+        u = rng.random()
+        if u < 0.85:
+            human.extend(Read(name) for _ in range(2 * copies))
+        if u > 0.15:
+            mouse.extend(Read(name) for _ in range(2 * copies))
+    return names, human, mouse
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark qname grouping of the disambiguate.py merge loop")
+    parser.add_argument("--reads", type=int, default=200000,
+                        help="Approximate number of records per species")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    names, human, mouse = make_reads(args.reads, args.seed)
+    n_records = len(human) + len(mouse)
+
+    sample = random.Random(args.seed).sample(names, min(len(names), 20000))
+    assert sorted(sample, key=qname_key) == sorted(sample, key=functools.cmp_to_key(strnum_cmp)), \
+        "qname_key() order differs from samtools strnum_cmp()"
+
+    start = time.perf_counter()
+    legacy = legacy_merge(human, mouse)
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    groups = list(merge_groups(human, mouse))
+    new_time = time.perf_counter() - start
+
+    assert [(len(h), len(m)) for h, m in legacy] == [(len(h), len(m)) for h, m in groups], \
+        "merge_groups() groups differ from the previous implementation"
+
+    print("records\t%d" % n_records)
+    print("nat_cmp reads/sec\t%.0f" % (n_records / legacy_time))
+    print("qname_key reads/sec\t%.0f" % (n_records / new_time))
+    print("speedup\t%.1fx" % (legacy_time / new_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+"""
+Deterministic generator of synthetic xenograft SHARE-seq test data.
+
+For n read pairs it writes:
+- human.bam / mouse.bam: species alignments in aligner order (the read pairs
+  in fastq order, all records of a read adjacent) with AS/NM/NH/XO tags,
+  multimappers, reads that only align to one species and ambiguous reads
+  with identical scores in both species
+- human.1to1.bam / mouse.1to1.bam: one record per mate in both species
+  (unmapped where the read did not align), the layout separate_reads.py expects
+- R1.fastq.gz / R2.fastq.gz: the reads of the species BAM files
+- rna.bam (+ .bai): coordinate sorted RNA alignments with CB/UB/GX tags,
+  mitochondrial reads, secondary alignments and '-' placeholders
+- atac.bam (+ .bai): coordinate sorted paired ATAC alignments with a CB tag
+- peaks.bed, chrom.sizes and barcodes.csv (a subset of the RNA/ATAC barcodes)
+
+Example:
+python benchmarks/generate_data.py --out_dir bench_data --reads 100000
+"""
+
+import argparse
+import gzip
+import json
+import os
+import random
+
+import pysam
+
+CHROMS = [("chr1", 2000000), ("chr2", 1500000), ("chr3", 1000000), ("chrM", 16569)]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Generate synthetic xenograft BAM/FASTQ files for benchmarking")
+    parser.add_argument("--out_dir", type=str, default="bench_data")
+    parser.add_argument("--reads", type=int, default=100000,
+                        help="Number of read pairs (and of RNA/ATAC reads)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--ambiguous_rate", type=float, default=0.05,
+                        help="Fraction of read pairs with equal scores in both species")
+    parser.add_argument("--multimapper_rate", type=float, default=0.1,
+                        help="Fraction of alignments with a second (secondary) hit")
+    parser.add_argument("--unaligned_rate", type=float, default=0.1,
+                        help="Fraction of read pairs that do not align to a species")
+    parser.add_argument("--barcodes", type=int, default=2000,
+                        help="Number of cell barcodes of the RNA and ATAC files")
+    return parser.parse_args()
+
+
+def random_seq(rng, length):
+    return "".join(rng.choice("ACGT") for _ in range(length))
+
+
+def make_header():
+    return {"HD": {"VN": "1.6", "SO": "unsorted"},
+            "SQ": [{"SN": name, "LN": length} for name, length in CHROMS]}
+
+
+def make_read(header, name, flag, seq, qual, tid=-1, pos=-1, tags=()):
+    read = pysam.AlignedSegment(header)
+    read.query_name = name
+    read.flag = flag
+    read.query_sequence = seq
+    read.query_qualities = qual
+    if tid >= 0:
+        read.reference_id = tid
+        read.reference_start = pos
+        read.mapping_quality = 60 if not flag & 256 else 0
+        read.cigartuples = [(0, len(seq))]
+    else:
+        read.flag |= 4
+    for tag, value in tags:
+        read.set_tag(tag, value)
+    return read
+
+
+def write_species(out_dir, n_reads, rng, ambiguous_rate, multimapper_rate, unaligned_rate, read_length=50):
+    """Write the species BAM files and fastq files; return record counts."""
+    header = pysam.AlignmentHeader.from_dict(make_header())
+    rounds = [[random_seq(rng, 8) for _ in range(96)] for _ in range(3)]
+    qual = pysam.qualitystring_to_array("I" * read_length)
+    bams = {s: pysam.AlignmentFile(os.path.join(out_dir, f"{s}.bam"), "wb", header=header)
+            for s in ("human", "mouse")}
+    one_to_one = {s: pysam.AlignmentFile(os.path.join(out_dir, f"{s}.1to1.bam"), "wb", header=header)
+                  for s in ("human", "mouse")}
+    fastqs = [gzip.open(os.path.join(out_dir, f"R{i}.fastq.gz"), "wt", compresslevel=1) for i in (1, 2)]
+    counts = {"human": 0, "mouse": 0, "pairs": n_reads}
+    nuclear = len(CHROMS) - 1
+
+    for i in range(n_reads):
+        name = "A00%d:%d:HXXXXXXXX:%d:%d:%d:%d_%s,%s,%s" % (
+            1 + i % 3, 100 + i // 1000000, 1 + (i // 250000) % 4, 1101 + (i // 5000) % 1500,
+            rng.randint(1, 32000), rng.randint(1, 32000), *[rng.choice(r) for r in rounds])
+        seqs = [random_seq(rng, read_length), random_seq(rng, read_length)]
+        for fastq, seq in zip(fastqs, seqs):
+            fastq.write(f"@{name}\n{seq}\n+\n{'I' * read_length}\n")
+
+        # scores: a lower edit distance / higher AS wins, equal scores are ambiguous
+        nm = {"human": rng.randint(0, 4), "mouse": rng.randint(0, 4)}
+        hits = {s: 2 if rng.random() < multimapper_rate else 1 for s in ("human", "mouse")}
+        if rng.random() < ambiguous_rate:
+            nm["mouse"], hits["mouse"] = nm["human"], hits["human"]
+        elif nm["mouse"] == nm["human"]:
+            nm["mouse"] = (nm["human"] + rng.randint(1, 4)) % 5
+        aligned = {s: rng.random() >= unaligned_rate for s in ("human", "mouse")}
+        for species in ("human", "mouse"):
+            tid, pos = rng.randrange(nuclear), rng.randint(0, 900000)
+            for mate, (mate_flag, seq) in enumerate(zip((0x40, 0x80), seqs)):
+                score = [("AS", 2 * read_length - 5 * nm[species]), ("NM", nm[species]),
+                         ("NH", hits[species]), ("XO", 0)]
+                if aligned[species]:
+                    for hit in range(hits[species]):
+                        flag = 1 | mate_flag | (256 if hit else 0)
+                        bams[species].write(make_read(header, name, flag, seq, qual,
+                                                      tid, pos + 300 * mate + 100000 * hit, score))
+                        counts[species] += 1
+                    one_to_one[species].write(make_read(header, name, 1 | mate_flag, seq, qual,
+                                                        tid, pos + 300 * mate, score))
+                else:
+                    one_to_one[species].write(make_read(header, name, 1 | mate_flag, seq, qual))
+
+    for f in list(bams.values()) + list(one_to_one.values()) + fastqs:
+        f.close()
+    return counts
+
+
+def write_coordinate_sorted(path, header, reads):
+    unsorted = path + ".unsorted.bam"
+    with pysam.AlignmentFile(unsorted, "wb", header=header) as f:
+        for read in reads:
+            f.write(read)
+    pysam.sort("-o", path, unsorted)
+    pysam.index(path)
+    os.remove(unsorted)
+
+
+def write_rna(out_dir, n_reads, rng, cell_barcodes, read_length=50):
+    """Write a coordinate sorted RNA BAM file with CB/UB/GX tags."""
+    header = pysam.AlignmentHeader.from_dict(make_header())
+    qual = pysam.qualitystring_to_array("I" * read_length)
+    seq = "A" * read_length
+    genes = [(f"ENSG{i:011d}", rng.randrange(len(CHROMS) - 1), rng.randint(0, 900000)) for i in range(2000)]
+    mito_genes = [(f"ENSG{90000000000 + i:011d}", len(CHROMS) - 1, 1000 * i) for i in range(13)]
+    umis = [random_seq(rng, 10) for _ in range(500)]  # small pool, so that there are PCR duplicates
+
+    def reads():
+        for i in range(n_reads):
+            gene, tid, pos = rng.choice(mito_genes) if rng.random() < 0.05 else rng.choice(genes)
+            tags = [("CB", rng.choice(cell_barcodes) if rng.random() > 0.02 else "-"),
+                    ("UB", rng.choice(umis) if rng.random() > 0.02 else "-"),
+                    ("GX", gene if rng.random() > 0.1 else "-")]
+            flag = 256 if rng.random() < 0.05 else 0
+            yield make_read(header, f"rna{i}", flag, seq, qual, tid, pos + rng.randint(0, 2000), tags)
+
+    write_coordinate_sorted(os.path.join(out_dir, "rna.bam"), header, reads())
+
+
+def write_atac(out_dir, n_reads, rng, cell_barcodes, read_length=50):
+    """Write a coordinate sorted paired ATAC BAM file, peaks.bed and chrom.sizes."""
+    header = pysam.AlignmentHeader.from_dict(make_header())
+    qual = pysam.qualitystring_to_array("I" * read_length)
+    seq = "A" * read_length
+    nuclear = CHROMS[:-1]
+    peaks = []
+    for tid, (chrom, length) in enumerate(nuclear):
+        for _ in range(length // 5000):
+            start = rng.randint(0, length - 1000)
+            peaks.append((tid, start, start + rng.randint(200, 1000)))
+    peaks.sort()
+
+    def reads():
+        for i in range(n_reads // 2):
+            # most fragments start in a peak
+            if rng.random() < 0.7:
+                tid, start, end = rng.choice(peaks)
+                pos = rng.randint(start, end)
+            else:
+                tid = rng.randrange(len(nuclear))
+                pos = rng.randint(0, nuclear[tid][1] - 2000)
+            insert = rng.randint(60, 600)
+            mate_pos = pos + insert - read_length
+            tags = [("CB", rng.choice(cell_barcodes))]
+            first = make_read(header, f"atac{i}", 1 | 2 | 0x20 | 0x40, seq, qual, tid, pos, tags)
+            second = make_read(header, f"atac{i}", 1 | 2 | 0x10 | 0x80, seq, qual, tid, mate_pos, tags)
+            first.next_reference_id = second.next_reference_id = tid
+            first.next_reference_start, second.next_reference_start = mate_pos, pos
+            first.template_length, second.template_length = insert, -insert
+            yield first
+            yield second
+
+    write_coordinate_sorted(os.path.join(out_dir, "atac.bam"), header, reads())
+    with open(os.path.join(out_dir, "peaks.bed"), "w") as f:
+        for tid, start, end in peaks:
+            f.write(f"{nuclear[tid][0]}\t{start}\t{end}\n")
+    with open(os.path.join(out_dir, "chrom.sizes"), "w") as f:
+        for chrom, length in CHROMS:
+            f.write(f"{chrom}\t{length}\n")
+
+
+def generate(out_dir, n_reads, seed=0, ambiguous_rate=0.05, multimapper_rate=0.1, unaligned_rate=0.1,
+             n_barcodes=2000):
+    """Generate all files into out_dir; returns a dict with the record counts of the inputs."""
+    os.makedirs(out_dir, exist_ok=True)
+    rng = random.Random(seed)
+    counts = write_species(out_dir, n_reads, rng, ambiguous_rate, multimapper_rate, unaligned_rate)
+    cell_barcodes = [random_seq(rng, 16) for _ in range(n_barcodes)]
+    write_rna(out_dir, n_reads, rng, cell_barcodes)
+    write_atac(out_dir, n_reads, rng, cell_barcodes)
+    with open(os.path.join(out_dir, "barcodes.csv"), "w") as f:
+        f.write("barcode\n")
+        for barcode in cell_barcodes[::2]:
+            f.write(barcode + "\n")
+    counts.update({"rna": n_reads, "atac": n_reads // 2 * 2})
+    with open(os.path.join(out_dir, "counts.json"), "w") as f:
+        json.dump(counts, f)
+    return counts
+
+
+def main():
+    args = parse_args()
+    counts = generate(args.out_dir, args.reads, args.seed, args.ambiguous_rate,
+                      args.multimapper_rate, args.unaligned_rate, args.barcodes)
+    print(json.dumps(counts))
+
+
+if __name__ == "__main__":
+    main()
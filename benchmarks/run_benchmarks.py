@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""
+Time the Xeno-share scripts on synthetic data at several scales.
+
+For every scale the data of generate_data.py is created (or reused) in
+<work_dir>/<reads>, then each script is run as its own process. Wall time,
+input records per second and the peak resident memory of the process are
+reported as JSON. The output directory of a script is emptied before it runs, so
+caches of an earlier run (e.g. the name sorted inputs of disambiguate.py) are not
+reused. Options of a script can be added with --args, e.g. to compare engines:
+
+python benchmarks/run_benchmarks.py --scales 10000 100000 --output bench.json
+python benchmarks/run_benchmarks.py --tools disambiguate --args "disambiguate=-e numpy"
+"""
+
+import argparse
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import time
+
+from generate_data import generate
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the Xeno-share scripts on synthetic data")
+    parser.add_argument("--scales", type=int, nargs="+", default=[10000, 100000],
+                        help="Numbers of read pairs to benchmark")
+    parser.add_argument("--work_dir", type=str, default="bench_work")
+    parser.add_argument("--tools", nargs="+", default=list(TOOLS),
+                        choices=list(TOOLS), help="Scripts to benchmark (in this order)")
+    parser.add_argument("--args", action="append", default=[], metavar="TOOL=ARGS",
+                        help="Extra command line arguments for a script")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default=None,
+                        help="JSON output file. Default: stdout")
+    return parser.parse_args()
+
+
+# script name, command line arguments and the input records (from counts.json) of each tool.
+# {d} is the data directory and {o} the output directory of the run
+TOOLS = {
+    "disambiguate": ("disambiguate.py",
+                     "-a bwa -o {o} -i {o}/interm {d}/human.bam {d}/mouse.bam",
+                     ("human", "mouse")),
+    "separate_reads": ("separate_reads.py",
+                       "--human_bam {d}/human.1to1.bam --mouse_bam {d}/mouse.1to1.bam "
+                       "--out_dir {o} --out_name sample",
+                       ("pairs", "pairs", "pairs", "pairs")),
+    "split_fastq_file": ("split_fastq_file.py",
+                         "--in_fastq {d}/R1.fastq.gz --human_reads {d}/../separate_reads/sample_human.csv "
+                         "--mouse_reads {d}/../separate_reads/sample_mouse.csv "
+                         "--human_fastq {o}/human_R1.fastq.gz --mouse_fastq {o}/mouse_R1.fastq.gz",
+                         ("pairs",)),
+    "separate_species": ("separate_species.py",
+                         "--human_bam {d}/human.bam --mouse_bam {d}/mouse.bam "
+                         "--fastq {d}/R1.fastq.gz {d}/R2.fastq.gz --out_dir {o} --out_name sample",
+                         ("human", "mouse", "pairs", "pairs")),
+    "rna_barcode_metadata": ("rna_barcode_metadata.py",
+                             "--bam_file {d}/rna.bam --bai_file {d}/rna.bam.bai "
+                             "--barcode_metadata_file {o}/barcode_metadata.txt",
+                             ("rna",)),
+    "bam_to_fragments": ("bam_to_fragments.py",
+                         "--bam {d}/atac.bam -o {o}/fragments.tsv",
+                         ("atac",)),
+    "bam_to_bw": ("bam_to_bw.py",
+                  "--bam_file {d}/atac.bam --peak_file {d}/peaks.bed --chrom_size_file {d}/chrom.sizes "
+                  "--out_dir {o} --out_name track",
+                  ("atac",)),
+    "filter_bam_by_barcode": ("filter_bam_by_barcode.py",
+                              "--bam_file {d}/atac.bam --barcode_file {d}/barcodes.csv "
+                              "--out_dir {o} --out_name filtered",
+                              ("atac",)),
+}
+
+# tools that read the output of another tool; the other tool is run first (untimed) if needed
+DEPENDS = {
+    "split_fastq_file": "separate_reads",
+}
+
+
+def run_command(cmd, log_file):
+    """Run cmd, return (seconds, peak RSS in MB, return code)."""
+    with open(log_file, "w") as log:
+        start = time.perf_counter()
+        proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
+        # wait4 gives the resource usage of this child alone
+        _, status, rusage = os.wait4(proc.pid, 0)
+        seconds = time.perf_counter() - start
+    return seconds, rusage.ru_maxrss / 1024, os.waitstatus_to_exitcode(status)
+
+
+def tool_command(tool, work_dir, scale, data_dir, extra_args):
+    """Command line of a tool and its (emptied) output directory."""
+    script, tool_args, _ = TOOLS[tool]
+    out_dir = os.path.join(work_dir, str(scale), tool)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.makedirs(out_dir)
+    cmd = ([sys.executable, os.path.join(REPO_DIR, script)]
+           + shlex.split(tool_args.format(d=data_dir, o=out_dir))
+           + shlex.split(extra_args.get(tool, "")))
+    return cmd, out_dir
+
+
+def main():
+    args = parse_args()
+    extra_args = dict(a.split("=", 1) for a in args.args)
+    results = []
+
+    for scale in args.scales:
+        data_dir = os.path.join(args.work_dir, str(scale), "data")
+        counts_file = os.path.join(data_dir, "counts.json")
+        if os.path.exists(counts_file):
+            with open(counts_file) as f:
+                counts = json.load(f)
+        else:
+            counts = generate(data_dir, scale, seed=args.seed)
+
+        done = set()
+        for tool in args.tools:
+            dependency = DEPENDS.get(tool)
+            if dependency is not None and dependency not in done:
+                cmd, out_dir = tool_command(dependency, args.work_dir, scale, data_dir, extra_args)
+                run_command(cmd, os.path.join(out_dir, "log.txt"))
+                done.add(dependency)
+
+            inputs = TOOLS[tool][2]
+            cmd, out_dir = tool_command(tool, args.work_dir, scale, data_dir, extra_args)
+            seconds, peak_rss_mb, returncode = run_command(cmd, os.path.join(out_dir, "log.txt"))
+            done.add(tool)
+            records = sum(counts[i] for i in inputs)
+            results.append({"tool": tool,
+                            "scale": scale,
+                            "args": extra_args.get(tool, ""),
+                            "records": records,
+                            "seconds": round(seconds, 3),
+                            "reads_per_sec": round(records / seconds, 1),
+                            "peak_rss_mb": round(peak_rss_mb, 1),
+                            "returncode": returncode})
+            print(f"{tool}\t{scale}\t{seconds:.2f}s\t{records / seconds:.0f} reads/s\t"
+                  f"{peak_rss_mb:.0f} MB\texit {returncode}", file=sys.stderr)
+
+    report = json.dumps({"python": sys.version.split()[0], "results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -24,32 +24,138 @@ for Tophat by Zhongwu Lai.
 
 
 from __future__ import print_function
-import sys, re, pysam
+import os, sys, re, gzip, json, time, zlib, shutil, struct, hashlib, pysam
+import numpy as np
 from array import array
-from os import path, makedirs
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from itertools import chain, islice
+from multiprocessing import Pool
+from os import path, makedirs, remove, rename
 from argparse import ArgumentParser, RawTextHelpFormatter
+from barcode_counts import BarcodeSpeciesCounts, get_barcode_function
+
+# classes of the per barcode counts
+SPECIES_A, SPECIES_B, AMBIGUOUS = 0, 1, 2
+SPECIES_CLASSES = ('speciesA', 'speciesB', 'ambiguous')
+
+class RunMetrics(object):
+    """Stage timings, counters and periodic progress of a run.
+
+    Timings are taken around blocks of read names rather than single reads, so
+    the overhead in the merge loop stays negligible. Progress goes to stderr
+    every progressinterval seconds (never if 0).
+    """
+
+    def __init__(self, progressinterval=60, label="disambiguate.py"):
+        self.progressinterval = progressinterval
+        self.label = label
+        self.stages = dict()
+        self.groups = 0
+        self.reads = 0
+        self.starttime = self.lastreporttime = time.time()
+        self.lastreportreads = 0
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def add_block(self, numgroups, numreads, qname):
+        self.groups += numgroups
+        self.reads += numreads
+        if self.progressinterval:
+            now = time.time()
+            if now - self.lastreporttime >= self.progressinterval:
+                sys.stderr.write("%s: %d read names, %d reads (%.0f reads/sec), at %s\n" % (
+                    self.label, self.groups, self.reads,
+                    (self.reads - self.lastreportreads) / (now - self.lastreporttime), qname))
+                self.lastreporttime = now
+                self.lastreportreads = self.reads
+
+    def update(self, other):
+        """Add the timings and counters of another run (e.g. of a shard)."""
+        for name, seconds in other.stages.items():
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+        self.groups += other.groups
+        self.reads += other.reads
+
+    def as_dict(self):
+        walltime = time.time() - self.starttime
+        return {"read_names": self.groups,
+                "reads": self.reads,
+                "wall_time_sec": round(walltime, 3),
+                "reads_per_sec": round(self.reads / walltime, 1) if walltime > 0 else None,
+                "stage_sec": dict((name, round(seconds, 3)) for name, seconds in self.stages.items())}
+
+
+# samtools sort -n orders read names "naturally" (strnum_cmp in bam_sort.c):
+# runs of digits are compared by numeric value, everything else byte by byte.
+# qname_key() encodes a read name once so that plain string comparison of two
+# keys gives exactly that order: every digit run is replaced by '0', a length
+# character and the digits without leading zeros. The '0' sorts against any
+# non-digit just like the original digit would, and the length character makes
+# longer numbers compare greater before their digits are looked at.
+_digit_run = re.compile('[0-9]+')
+
+def _encode_digit_run(match):
+    digits = match.group().lstrip('0')
+    return '0' + chr(len(digits)) + digits
+
+def qname_key(qname):
+    return _digit_run.sub(_encode_digit_run, qname)
 
 # "natural comparison" for strings
 def nat_cmp(a, b):
-    convert = lambda text: int(text) if text.isdigit() else text # lambda function to convert text to int if number present
-    alphanum_key = lambda key: [ convert(c) for c in re.split('([0-9]+)', key) ] # split string to piecewise strings and string numbers
-    #return cmp(alphanum_key(a), alphanum_key(b)) # use internal cmp to compare piecewise strings and numbers
-    return (alphanum_key(a) > alphanum_key(b))-(alphanum_key(a) < alphanum_key(b))
-
-# read reads into a list object for as long as the read qname is constant (sorted file). Return the first read with new qname or None
-def read_next_reads(fileobject, listobject):
-    qnamediff = False
-    while not qnamediff:
-        try:
-            myRead=fileobject.next()
-        except StopIteration:
-            #print("5")
-            return None # return None as the name of the new reads (i.e. no more new reads)
-        if nat_cmp(myRead.qname, listobject[0].qname)==0:
-            listobject.append(myRead)
-        else:
-            qnamediff = True
-    return myRead # this is the first read with a new qname
+    a, b = qname_key(a), qname_key(b)
+    return (a > b)-(a < b)
+
+# group consecutive reads with the same qname (sorted file). Yields (key, list of reads);
+# the natural-order key is built once per qname instead of once per comparison
+def read_groups(fileobject):
+    reads = list()
+    qname = key = None
+    for myRead in fileobject:
+        if myRead.query_name != qname:
+            qname = myRead.query_name
+            newkey = qname_key(qname)
+            if newkey != key: # names like 'r01' and 'r1' are equal for samtools
+                if reads:
+                    yield key, reads
+                reads = list()
+                key = newkey
+        reads.append(myRead)
+    if reads:
+        yield key, reads
+
+# walk the qname groups of two name sorted files in step. Yields (humanlist, mouselist)
+# in qname order, one of the lists is empty if the qname is only present in one file
+def merge_groups(humanfile, mousefile):
+    humgroups = read_groups(humanfile)
+    mougroups = read_groups(mousefile)
+    humkey, humlist = next(humgroups, (None, None))
+    moukey, moulist = next(mougroups, (None, None))
+    while humlist is not None and moulist is not None:
+        if humkey == moukey:
+            yield humlist, moulist
+            humkey, humlist = next(humgroups, (None, None))
+            moukey, moulist = next(mougroups, (None, None))
+        elif humkey < moukey: # mouse is "ahead" of human
+            yield humlist, []
+            humkey, humlist = next(humgroups, (None, None))
+        else: # human is "ahead" of mouse
+            yield [], moulist
+            moukey, moulist = next(mougroups, (None, None))
+    # flush whatever is left in either file
+    while humlist is not None:
+        yield humlist, []
+        humkey, humlist = next(humgroups, (None, None))
+    while moulist is not None:
+        yield [], moulist
+        moukey, moulist = next(mougroups, (None, None))
 
 # disambiguate between two lists of reads
 def disambiguate(humanlist, mouselist, disambalgo):
@@ -137,6 +243,500 @@ def disambiguate(humanlist, mouselist, disambalgo):
         sys.exit(2)
 
 
+# disambiguate blocks of (humanlist, mouselist) groups at once; gives exactly the same
+# verdicts as disambiguate(). The tags are collected read by read (with the same fallbacks,
+# e.g. the switch to STAR's nM) into flat arrays, the best score per group and
+# species/mate is then found with numpy reductions and all groups are compared together
+def disambiguate_batch(pairs, disambalgo):
+    numpairs = len(pairs)
+    groupidx = list()
+    column = list()
+    if disambalgo in ['tophat','hisat2']:
+        scores = list()
+        for g, (humanlist, mouselist) in enumerate(pairs):
+            for offset, readlist in ((0, humanlist), (2, mouselist)):
+                for read in readlist:
+                    if 0x4&read.flag: # flag 0x4 means unaligned
+                        continue
+                    groupidx.append(g)
+                    column.append(offset if 0x40&read.flag else offset+1) # directionality (_1 or _2)
+                    scores.append(read.get_tag('XO') + read.get_tag('NM') + read.get_tag('NH'))
+        sa = np.full((numpairs, 4), 2**13, dtype=np.int64) # same default as disambiguate()
+        np.minimum.at(sa, (np.array(groupidx, dtype=np.intp), np.array(column, dtype=np.intp)),
+                      np.array(scores, dtype=np.int64))
+        hmin, hmax = sa[:, 0:2].min(axis=1), sa[:, 0:2].max(axis=1)
+        mmin, mmax = sa[:, 2:4].min(axis=1), sa[:, 2:4].max(axis=1)
+        ambiguous = (hmin == mmin) & (hmax == mmax)
+        human = (hmin < mmin) | (hmin == mmin) & (hmax < mmax)
+        return np.where(ambiguous, 0, np.where(human, 1, -1)).tolist()
+    elif disambalgo.lower() in ('bwa', 'star', 'bowtie2'):
+        bwatagsigns = [1, -1]
+        tagidx = list()
+        scores = list()
+        for g, (humanlist, mouselist) in enumerate(pairs):
+            bwatags = ['AS', 'NM'] # per group, as in disambiguate()
+            for offset, readlist in ((0, humanlist), (2, mouselist)):
+                for read in readlist:
+                    if 0x4&read.flag: # flag 0x4 means unaligned
+                        continue
+                    d12 = offset if 0x40&read.flag else offset+1 # directionality (_1 or _2)
+                    for x in range(0, len(bwatagsigns)):
+                        try:
+                            QScore = bwatagsigns[x]*read.get_tag(bwatags[x])
+                        except KeyError:
+                            if bwatags[x] == 'NM':
+                                bwatags[x] = 'nM' # oddity of STAR
+                            elif bwatags[x] == 'AS':
+                                continue # this can happen for e.g. hg38 ALT-alignments (missing AS)
+                            QScore = bwatagsigns[x]*read.get_tag(bwatags[x])
+                        groupidx.append(g)
+                        tagidx.append(x)
+                        column.append(d12)
+                        scores.append(QScore)
+        AS = np.full((len(bwatagsigns), numpairs, 4), -2^13, dtype=np.int64) # same default as disambiguate()
+        np.maximum.at(AS, (np.array(tagidx, dtype=np.intp), np.array(groupidx, dtype=np.intp),
+                           np.array(column, dtype=np.intp)), np.array(scores, dtype=np.int64))
+        verdicts = np.zeros(numpairs, dtype=np.int64)
+        undecided = np.ones(numpairs, dtype=bool)
+        for x in range(0, len(bwatagsigns)): # tags in order of importance
+            hmin, hmax = AS[x, :, 0:2].min(axis=1), AS[x, :, 0:2].max(axis=1)
+            mmin, mmax = AS[x, :, 2:4].min(axis=1), AS[x, :, 2:4].max(axis=1)
+            human = undecided & ((hmax > mmax) | (hmax == mmax) & (hmin > mmin))
+            mouse = undecided & ((hmax < mmax) | (hmax == mmax) & (hmin < mmin))
+            verdicts[human] = 1
+            verdicts[mouse] = -1
+            undecided &= ~(human | mouse)
+        return verdicts.tolist()
+    else:
+        print("Not implemented yet")
+        sys.exit(2)
+
+
+# verdicts for a block of (humanlist, mouselist) groups; None if the read name is only
+# present in one of the files
+def score_block(block, disambalgo, engine='python'):
+    if engine == 'numpy':
+        pairs = [pair for pair in block if pair[0] and pair[1]]
+        verdicts = iter(disambiguate_batch(pairs, disambalgo)) if pairs else iter(())
+        return [next(verdicts) if humlist and moulist else None for humlist, moulist in block]
+    return [disambiguate(humlist, moulist, disambalgo) if humlist and moulist else None
+            for humlist, moulist in block]
+
+
+# one byte per verdict in the classification files
+VERDICT_BYTES = (b'A', b'B', b'N') # SPECIES_A, SPECIES_B, AMBIGUOUS
+
+
+class BamOutput(object):
+    """The four output BAM files: disambiguated A, ambiguous A, disambiguated B, ambiguous B.
+    """
+
+    def __init__(self, outputfilenames, humantemplate, mousetemplate, threads=1, writeoptions=()):
+        self.humanunique, self.humanambiguous, self.mouseunique, self.mouseambiguous = [
+            pysam.Samfile(f, "wb", template=template, threads=threads, format_options=list(writeoptions))
+            for f, template in zip(outputfilenames, (humantemplate, humantemplate, mousetemplate, mousetemplate))]
+
+    def write(self, humlist, moulist, myClass):
+        if myClass == SPECIES_A:
+            for myRead in humlist:
+                self.humanunique.write(myRead)
+        elif myClass == SPECIES_B:
+            for myRead in moulist:
+                self.mouseunique.write(myRead)
+        else:
+            for myRead in moulist:
+                self.mouseambiguous.write(myRead)
+            for myRead in humlist:
+                self.humanambiguous.write(myRead)
+
+    def close(self):
+        for myFile in (self.humanunique, self.humanambiguous, self.mouseunique, self.mouseambiguous):
+            myFile.close()
+
+
+def qname_hash(qname):
+    """64-bit hash of a read name as stored in hash classification files.
+    """
+    return struct.unpack('<Q', hashlib.blake2b(qname.encode(), digest_size=8).digest())[0]
+
+
+class ClassificationOutput(object):
+    """Read name classification instead of BAM files. With format 'qname' a gzipped text
+    file with lines 'qname<TAB>verdict', with format 'hash' a binary file of 9-byte records:
+    qname_hash() as little-endian unsigned 64-bit integer followed by the verdict byte.
+    The verdict is A (species A), B (species B) or N (ambiguous). The gzip level is taken
+    from a "level=N" write option of the BAM files (-l), else it is 1.
+    """
+
+    def __init__(self, filename, format='qname', writeoptions=()):
+        self.format = format
+        if format == 'hash':
+            self.file = open(filename, 'wb', buffering=1<<20)
+        else:
+            level = 1
+            for option in writeoptions:
+                if option.startswith(b'level='):
+                    level = int(option[len(b'level='):])
+            self.file = gzip.open(filename, 'wt', compresslevel=level)
+
+    def write(self, humlist, moulist, myClass):
+        qname = (humlist or moulist)[0].query_name
+        if self.format == 'hash':
+            self.file.write(struct.pack('<Q', qname_hash(qname)) + VERDICT_BYTES[myClass])
+        else:
+            self.file.write(qname+'\t'+VERDICT_BYTES[myClass].decode()+'\n')
+
+    def close(self):
+        self.file.close()
+
+
+def output_filenames(outputdir, humanprefix, mouseprefix, classification=None):
+    """Output files of a run: the four BAM files or the classification file.
+    """
+    if classification == 'hash':
+        return (path.join(outputdir, humanprefix+".classification.bin"),)
+    if classification:
+        return (path.join(outputdir, humanprefix+".classification.tsv.gz"),)
+    return (path.join(outputdir, humanprefix+".disambiguatedSpeciesA.bam"),
+            path.join(outputdir, humanprefix+".ambiguousSpeciesA.bam"),
+            path.join(outputdir, mouseprefix+".disambiguatedSpeciesB.bam"),
+            path.join(outputdir, mouseprefix+".ambiguousSpeciesB.bam"))
+
+
+# disambiguate (humanlist, mouselist) read groups and write them to output (a BamOutput or
+# ClassificationOutput), blocksize groups at a time. Returns the number of read names assigned to
+# A, B and ambiguous. If barcodecounts is given, every read name is also counted for the barcode
+# barcodefunc finds in its first read. Stage timings and progress go to metrics (a RunMetrics)
+# once per block
+def disambiguate_groups(groups, output, disambalgo, engine='python', barcodecounts=None, barcodefunc=None,
+                        metrics=None, blocksize=4096):
+    if metrics is None:
+        metrics = RunMetrics(0)
+    numhum = nummou = numamb = 0
+    groups = iter(groups)
+    while True:
+        with metrics.stage('merge'): # reading, decompressing and grouping the inputs
+            block = list(islice(groups, blocksize))
+        if not block:
+            break
+        with metrics.stage('score'):
+            verdicts = score_block(block, disambalgo, engine)
+        with metrics.stage('write'):
+            for (humlist, moulist), myAmbiguousness in zip(block, verdicts):
+                if not moulist: # only aligned to human, output to human disambiguous
+                    numhum+=1 # increment human counter for unique only
+                    myClass = SPECIES_A
+                elif not humlist: # only aligned to mouse, output to mouse disambiguous
+                    nummou+=1 # increment mouse counter for unique only
+                    myClass = SPECIES_B
+                # comparison checked mouse, human or ambiguous
+                elif myAmbiguousness < 0: # mouse
+                    nummou+=1 # increment mouse counter
+                    myClass = SPECIES_B
+                elif myAmbiguousness > 0: # human
+                    numhum+=1 # increment human counter
+                    myClass = SPECIES_A
+                else: # ambiguous
+                    numamb+=1 # increment ambiguous counter
+                    myClass = AMBIGUOUS
+                output.write(humlist, moulist, myClass)
+                if barcodecounts is not None:
+                    barcode = barcodefunc((humlist or moulist)[0])
+                    if barcode is not None:
+                        barcodecounts.add(barcode, myClass)
+        metrics.add_block(len(block), sum(len(humlist)+len(moulist) for humlist, moulist in block),
+                          (block[-1][0] or block[-1][1])[0].query_name)
+    return numhum, nummou, numamb
+
+
+class OutOfOrderError(ValueError):
+    """The read names of two collated files are not in the same order and a read name was
+    already output as found in one file only.
+    """
+
+
+# walk the qname groups of two collated files (e.g. straight from the aligner, both in the
+# order of the fastq files) in lockstep. A qname that is only in one file (e.g. unaligned reads
+# left out) is resynced on: the groups not matched yet are held by qname key, and when a group
+# of one file matches a held group of the other, the held groups before it can no longer match.
+# Those one-sided groups are held for another window groups before they are yielded on their
+# own, and their keys are remembered for another 4*window groups after that. If a later group
+# matches a held one-sided group, or more than window groups are held unmatched (the files are
+# not in the same order), the held groups and the rest of both files are hash bucketed on disk
+# under bucketprefix and the buckets are matched up in memory. A group matching a one-sided
+# group that was already yielded raises OutOfOrderError. label names the tool in the warning
+def lockstep_groups(humanfile, mousefile, bucketprefix, numbuckets=64, window=1<<16, label='disambiguate.py'):
+    humgroups = read_groups(humanfile)
+    mougroups = read_groups(mousefile)
+    humpending, moupending = dict(), dict()
+    onesided = OrderedDict() # key -> (humanlist, mouselist) of the held one-sided groups
+    yieldedkeys, yieldedorder = set(), deque()
+
+    # check a group against the one-sided groups; True if it matches a held one
+    def matches_onesided(key, reads):
+        if key in yieldedkeys:
+            raise OutOfOrderError("read name "+reads[0].query_name+" was already output as found in one "
+                                  "input file only; the input files do not list the read names in the same order")
+        return key in onesided
+
+    # add a group of one file; yields what can be yielded once it is matched or not
+    def add(key, reads, pending, otherpending, is_human):
+        if key not in otherpending:
+            pending.setdefault(key, []).extend(reads)
+            return
+        for heldkey, heldreads in pending.items():
+            onesided[heldkey] = (heldreads, []) if is_human else ([], heldreads)
+        pending.clear()
+        for heldkey in list(otherpending):
+            heldreads = otherpending.pop(heldkey)
+            if heldkey == key:
+                yield (reads, heldreads) if is_human else (heldreads, reads)
+                break
+            onesided[heldkey] = ([], heldreads) if is_human else (heldreads, [])
+        while len(onesided) > window:
+            heldkey, group = onesided.popitem(last=False)
+            yieldedkeys.add(heldkey)
+            yieldedorder.append(heldkey)
+            if len(yieldedorder) > 4*window:
+                yieldedkeys.discard(yieldedorder.popleft())
+            yield group
+
+    humdone = moudone = False
+    while not (humdone and moudone):
+        if not humdone:
+            humkey, humlist = next(humgroups, (None, None))
+            humdone = humlist is None
+            if not humdone:
+                if matches_onesided(humkey, humlist):
+                    humgroups = chain([(humkey, humlist)], humgroups)
+                    atread = humlist[0].query_name
+                    break
+                yield from add(humkey, humlist, humpending, moupending, True)
+        if not moudone:
+            moukey, moulist = next(mougroups, (None, None))
+            moudone = moulist is None
+            if not moudone:
+                if matches_onesided(moukey, moulist):
+                    mougroups = chain([(moukey, moulist)], mougroups)
+                    atread = moulist[0].query_name
+                    break
+                yield from add(moukey, moulist, moupending, humpending, False)
+        if len(humpending) + len(moupending) > window:
+            atread = next(chain(humpending.values(), moupending.values()))[0].query_name
+            break
+    else:
+        # both files are read, nothing held can be matched anymore
+        yield from onesided.values()
+        for humlist in humpending.values():
+            yield humlist, []
+        for moulist in moupending.values():
+            yield [], moulist
+        return
+
+    sys.stderr.write(label+": read names of the input files out of order at read "+atread+
+                     ", bucketing the remaining reads\n")
+    humbuckets = [bucketprefix+".bucket%d.speciesA.bam" % i for i in range(numbuckets)]
+    moubuckets = [bucketprefix+".bucket%d.speciesB.bam" % i for i in range(numbuckets)]
+    partition_reads(chain(chain.from_iterable(humlist for humlist, moulist in onesided.values()),
+                          chain.from_iterable(humpending.values()), chain.from_iterable(g for k, g in humgroups)),
+                    humanfile, humbuckets)
+    partition_reads(chain(chain.from_iterable(moulist for humlist, moulist in onesided.values()),
+                          chain.from_iterable(moupending.values()), chain.from_iterable(g for k, g in mougroups)),
+                    mousefile, moubuckets)
+    onesided.clear()
+    humpending.clear()
+    moupending.clear()
+    try:
+        for humbucket, moubucket in zip(humbuckets, moubuckets):
+            humdict = bucket_groups(humbucket)
+            moudict = bucket_groups(moubucket)
+            for key, humlist in humdict.items():
+                matches_onesided(key, humlist)
+                yield humlist, moudict.pop(key, [])
+            for key, moulist in moudict.items():
+                matches_onesided(key, moulist)
+                yield [], moulist
+    finally:
+        for bucketfilename in humbuckets + moubuckets:
+            remove(bucketfilename)
+
+
+# read a hash bucket into an (insertion ordered) dictionary of qname key -> list of reads
+def bucket_groups(filename):
+    groups = dict()
+    myFile = pysam.Samfile(filename, "rb")
+    for key, reads in read_groups(myFile):
+        groups.setdefault(key, list()).extend(reads)
+    myFile.close()
+    return groups
+
+
+# disambiguate two BAM files, name sorted or (if collated) grouped by qname in the same order.
+# outputfilenames are the disambiguated A, ambiguous A, disambiguated B and ambiguous B BAM files,
+# or with classification ('qname' or 'hash') the classification file (see ClassificationOutput).
+# Returns the number of read names assigned to A, B and ambiguous, and the per barcode counts
+# (a BarcodeSpeciesCounts) if barcodesource ('qname' or a BAM tag) is given, else None.
+# Timings and counters are added to metrics (a RunMetrics) if given
+def disambiguate_files(humanfilename, mousefilename, outputfilenames, disambalgo, threads=1, writeoptions=(),
+                       collated=False, bucketprefix=None, engine='python', barcodesource=None, metrics=None,
+                       classification=None):
+    myHumanFile = pysam.Samfile(humanfilename, "rb", threads=threads)
+    myMouseFile = pysam.Samfile(mousefilename, "rb", threads=threads)
+    if classification:
+        output = ClassificationOutput(outputfilenames[0], classification, writeoptions)
+    else:
+        output = BamOutput(outputfilenames, myHumanFile, myMouseFile, threads, writeoptions)
+
+    if collated:
+        groups = lockstep_groups(myHumanFile, myMouseFile, bucketprefix)
+    else:
+        groups = merge_groups(myHumanFile, myMouseFile)
+    if barcodesource:
+        barcodecounts = BarcodeSpeciesCounts(SPECIES_CLASSES)
+        barcodefunc = get_barcode_function(barcodesource)
+    else:
+        barcodecounts = barcodefunc = None
+    numhum, nummou, numamb = disambiguate_groups(groups, output, disambalgo, engine,
+                                                 barcodecounts, barcodefunc, metrics)
+
+    myHumanFile.close()
+    myMouseFile.close()
+    output.close()
+    return numhum, nummou, numamb, barcodecounts
+
+
+# disambiguate_files for one shard of disambiguate_sharded; also returns the RunMetrics of the shard
+def disambiguate_shard(shard, progressinterval, classification, *args):
+    metrics = RunMetrics(progressinterval, "disambiguate.py shard %d" % shard)
+    return disambiguate_files(*args, metrics=metrics, classification=classification) + (metrics,)
+
+
+# hash-partition reads by qname. All reads of a qname end up in the same shard and every
+# shard keeps the input order. Shards are intermediate files, so use fast compression
+def partition_reads(reads, template, shardfilenames):
+    shards = [pysam.Samfile(f, "wb", template=template, format_options=[b"level=1"]) for f in shardfilenames]
+    qname = shard = None
+    for myRead in reads:
+        if myRead.query_name != qname:
+            qname = myRead.query_name
+            # hash the natural-order key so that names samtools considers equal stay together
+            shard = shards[zlib.crc32(qname_key(qname).encode()) % len(shards)]
+        shard.write(myRead)
+    for shard in shards:
+        shard.close()
+
+
+# hash-partition a BAM file by qname, see partition_reads
+def partition_bam(filename, shardfilenames, threads=1):
+    infile = pysam.Samfile(filename, "rb", threads=threads)
+    partition_reads(infile, infile, shardfilenames)
+    infile.close()
+
+
+# write the header of a BAM file to a SAM file headerfilename, with the @HD line saying that the
+# reads are grouped by read name but not sorted (e.g. for concatenated shards)
+def write_grouped_header(filename, headerfilename):
+    myFile = pysam.Samfile(filename, "rb")
+    header = myFile.header.to_dict()
+    myFile.close()
+    hd = dict(header.get('HD', {'VN': '1.6'}))
+    for tag in ('SO', 'SS', 'GO'):
+        hd.pop(tag, None)
+    hd.update(SO='unsorted', GO='query')
+    header['HD'] = hd
+    pysam.Samfile(headerfilename, "wh", header=header).close()
+
+
+# disambiguate in a pool of processes: partition both files into one shard per process,
+# disambiguate the shard pairs independently and concatenate the shard outputs.
+# The outputs are name sorted (or collated) per shard only, so their @HD line says
+# SO:unsorted GO:query. Returns the summed counts of disambiguate_files;
+# the timings of the shards are summed into metrics
+def disambiguate_sharded(humanfilename, mousefilename, outputfilenames, disambalgo, processes, shardprefix,
+                         threads=1, writeoptions=(), collated=False, engine='python', barcodesource=None,
+                         metrics=None, classification=None):
+    if metrics is None:
+        metrics = RunMetrics(0)
+    humanshards = [shardprefix+".shard%d.speciesA.bam" % i for i in range(processes)]
+    mouseshards = [shardprefix+".shard%d.speciesB.bam" % i for i in range(processes)]
+    shardoutputs = [[shardprefix+".shard%d.%s" % (i, path.basename(f)) for f in outputfilenames]
+                    for i in range(processes)]
+    pool = Pool(processes)
+    try:
+        with metrics.stage('partition'):
+            pool.starmap(partition_bam, [(humanfilename, humanshards, threads),
+                                         (mousefilename, mouseshards, threads)])
+        counts = pool.starmap(disambiguate_shard,
+                              [(i, metrics.progressinterval, classification, humanshards[i], mouseshards[i],
+                                shardoutputs[i], disambalgo, 1, writeoptions, collated,
+                                shardprefix+".shard%d" % i, engine, barcodesource) for i in range(processes)])
+    finally:
+        pool.close()
+        pool.join()
+    for count in counts:
+        metrics.update(count[4])
+    # samtools cat copies the compressed blocks, no recompression needed. Gzip members and
+    # binary records can simply be appended to each other
+    headerfilename = shardprefix+".header.sam"
+    with metrics.stage('concatenate'):
+        for i, outputfilename in enumerate(outputfilenames):
+            if classification:
+                with open(outputfilename, 'wb') as outputfile:
+                    for shardoutput in shardoutputs:
+                        with open(shardoutput[i], 'rb') as shardfile:
+                            shutil.copyfileobj(shardfile, outputfile)
+            else:
+                write_grouped_header(shardoutputs[0][i], headerfilename)
+                pysam.cat("-h", headerfilename, "-o", outputfilename, *[shardoutput[i] for shardoutput in shardoutputs])
+                remove(headerfilename)
+    for shardfilename in humanshards + mouseshards + sum(shardoutputs, []):
+        remove(shardfilename)
+    barcodecounts = None
+    if barcodesource:
+        barcodecounts = BarcodeSpeciesCounts(SPECIES_CLASSES)
+        for count in counts:
+            barcodecounts.update(count[3])
+    numhum, nummou, numamb = [sum(count[i] for count in counts) for i in range(3)]
+    return numhum, nummou, numamb, barcodecounts
+
+
+# name sort a BAM file with samtools into sortedfilename. The sort goes to a temporary file
+# first and a marker file records the size and mtime of the input and the size of the result
+# once it is complete, so that a truncated sort from a crashed job is never reused
+def name_sort(filename, sortedfilename, threads=1, memory="2000000000"):
+    markerfilename = sortedfilename+".done"
+    partialfilename = sortedfilename+".partial"
+    if path.exists(markerfilename):
+        remove(markerfilename)
+    pysam.sort("-n", "-@", str(threads), "-m", str(memory), "-O", "bam", "-T", partialfilename,
+               "-o", partialfilename, filename)
+    rename(partialfilename, sortedfilename)
+    stamp = sort_stamp(filename)
+    stamp["sorted_size"] = path.getsize(sortedfilename)
+    with open(markerfilename, "w") as markerfile:
+        json.dump(stamp, markerfile)
+
+
+def sort_stamp(filename):
+    """Identify a version of an input file by path, size and modification time.
+    """
+    stat = os.stat(filename)
+    return {"input": path.abspath(filename), "input_size": stat.st_size, "input_mtime_ns": stat.st_mtime_ns}
+
+
+def is_sorted_copy(filename, sortedfilename):
+    """Check if sortedfilename is a complete name sort of the current version of filename.
+    """
+    try:
+        with open(sortedfilename+".done") as markerfile:
+            stamp = json.load(markerfile)
+        expected = sort_stamp(filename)
+        expected["sorted_size"] = path.getsize(sortedfilename)
+    except (OSError, ValueError):
+        return False
+    return stamp == expected
+
+
 def main():
     description = """
 disambiguate.py disambiguates between two organisms that have alignments
@@ -162,11 +762,20 @@ The output directory will contain four files:\n
 ...disambiguatedSpeciesB.bam: Reads that could be assigned to species B
 ...ambiguousSpeciesA.bam: Reads aligned to species A that also aligned \n\tto B but could not be uniquely assigned to either
 ...ambiguousSpeciesB.bam: Reads aligned to species B that also aligned \n\tto A but could not be uniquely assigned to either
+...classification.tsv.gz/.bin: Verdict per read name instead of the \n\tBAM files (only with -r)
 ..._summary.txt: A summary of unique read names assigned to species A, B \n\tand ambiguous.
+..._barcode_counts.csv: The same counts per cell barcode (only with -b).
+..._metrics.json: Run metrics: reads, read names, reads/sec and the time \n\tspent per stage (sort, merge, score, write, ...; summed over shards).
 
 Examples:
 disambiguate.py test/human.bam test/mouse.bam
 disambiguate.py -s mysample1 test/human.bam test/mouse.bam
+disambiguate.py -t 8 -l 1 test/human.bam test/mouse.bam
+disambiguate.py -p 32 test/human.bam test/mouse.bam
+disambiguate.py --sort-threads 8 --sort-memory 1G test/human.bam test/mouse.bam
+disambiguate.py -b qname test/human.bam test/mouse.bam
+disambiguate.py -r qname test/human.bam test/mouse.bam
+disambiguate.py -c -a bwa test/human.unsorted.bam test/mouse.unsorted.bam
    """
 
     parser = ArgumentParser(description=description, formatter_class=RawTextHelpFormatter)
@@ -175,10 +784,28 @@ disambiguate.py -s mysample1 test/human.bam test/mouse.bam
     parser.add_argument('-o', '--output-dir', default="disambres",
                         help='Output directory.')
     parser.add_argument('-i', '--intermediate-dir', default="intermfiles",
-                        help='Location to store intermediate files')
+                        help='Location to store intermediate files. Name '
+                        'sorted inputs are kept here and reused by later runs '
+                        'as long as the input file is unchanged.')
     parser.add_argument('-d', '--no-sort', action='store_true', default=False,
                         help='Disable BAM file sorting. Use this option if the '
                         'files have already been name sorted.')
+    parser.add_argument('--sort-threads', type=int, default=1,
+                        help='Number of threads of each of the two (concurrent) '
+                        'name sorts.')
+    parser.add_argument('--sort-memory', default='2000000000',
+                        help='Memory per sorting thread, with optional K/M/G '
+                        'suffix (samtools sort -m).')
+    parser.add_argument('-c', '--collated', action='store_true', default=False,
+                        help='Input BAM files are not sorted but collated, i.e. '
+                        'all reads of a read name are adjacent and both files '
+                        'list the read names in the same (e.g. fastq) order, as '
+                        'written by the aligner. The files are read in lockstep '
+                        'without sorting, skipping read names that are only in '
+                        'one file; if they fall out of order, the remaining '
+                        'reads are hash bucketed in the intermediate directory. '
+                        'If a read name turns up after it was already written '
+                        'as found in one file only, the run stops with an error.')
     parser.add_argument('-s', '--prefix', default='',
                         help='A prefix (e.g. sample name) to use for the output '
                         'BAM files. If not provided, the input BAM file prefix '
@@ -187,10 +814,46 @@ disambiguate.py -s mysample1 test/human.bam test/mouse.bam
                         choices=('tophat', 'hisat2', 'bwa', 'star', 'bowtie2'),
                         help='The aligner used to generate these reads. Some '
                         'aligners set different tags.')
+    parser.add_argument('-e', '--engine', default='python', choices=('python', 'numpy'),
+                        help='Scoring engine. numpy collects the tags of '
+                        'thousands of read names at a time and compares them '
+                        'with vectorized reductions; the result is identical.')
+    parser.add_argument('-t', '--threads', type=int, default=1,
+                        help='Number of htslib threads used for BGZF '
+                        'decompression and compression of each input and '
+                        'output BAM file.')
+    parser.add_argument('-l', '--compression-level', type=int, default=None,
+                        choices=range(0, 10), metavar='{0-9}',
+                        help='BGZF compression level of the output BAM files '
+                        '(e.g. 1 for intermediate files), also the gzip level '
+                        'of the -r qname file. Default: the htslib default '
+                        'level for BAM files and level 1 for the -r qname file.')
+    parser.add_argument('-p', '--processes', type=int, default=1,
+                        help='Disambiguate in parallel: hash-partition both '
+                        'inputs by read name into this many shards (stored in '
+                        'the intermediate directory) and process them in a pool '
+                        'of processes. The output BAM files are then name '
+                        'sorted within each shard only, and their header says '
+                        'SO:unsorted GO:query.')
+    parser.add_argument('-b', '--barcode-counts', default=None, metavar='{qname,TAG}',
+                        help='Also count the read names assigned to species A, '
+                        'B and ambiguous per cell barcode, taking the barcode '
+                        'from the SHARE-seq read name (qname) or from a BAM tag '
+                        '(e.g. CB). Writes ..._barcode_counts.csv.')
+    parser.add_argument('-r', '--classification', default=None, choices=('qname', 'hash'),
+                        help='Do not write BAM files, only the verdict per read '
+                        'name: qname writes ...classification.tsv.gz with lines '
+                        '"read name<TAB>A|B|N" (gzip level of -l, default 1), '
+                        'hash writes ...classification.bin with 9-byte records '
+                        '(64-bit read name hash, little-endian, and the verdict '
+                        'byte). N means ambiguous.')
+    parser.add_argument('--progress-interval', type=float, default=60,
+                        help='Report progress (reads/sec, read names done, current '
+                        'read name) to stderr every this many seconds; 0 '
+                        'disables it.')
     args = parser.parse_args()
 
     #code
-    numhum = nummou = numamb = 0
     #starttime = time.clock()
     # parse inputs
     humanfilename = args.A
@@ -200,6 +863,17 @@ disambiguate.py -s mysample1 test/human.bam test/mouse.bam
     intermdir = args.intermediate_dir
     disablesort = args.no_sort
     disambalgo = args.aligner
+    threads = args.threads
+    processes = args.processes
+    collated = args.collated
+    engine = args.engine
+    sortthreads = args.sort_threads
+    sortmemory = args.sort_memory
+    barcodesource = args.barcode_counts
+    metrics = RunMetrics(args.progress_interval)
+    classification = args.classification
+    # htslib picks the BGZF level up from the "level" format option of the writers
+    writeoptions = [] if args.compression_level is None else [("level=%d" % args.compression_level).encode()]
     supportedalgorithms = set(['tophat', 'hisat2', 'bwa', 'star', 'bowtie2'])
 
     # check existence of input BAM files
@@ -220,7 +894,7 @@ disambiguate.py -s mysample1 test/human.bam test/mouse.bam
         print(disambalgo+" is not a supported disambiguation scheme at the moment.")
         sys.exit(2)
 
-    if disablesort:
+    if disablesort or collated:
         humanfilenamesorted = humanfilename # assumed to be sorted externally...
         mousefilenamesorted = mousefilename # assumed to be sorted externally...
     else:
@@ -228,119 +902,50 @@ disambiguate.py -s mysample1 test/human.bam test/mouse.bam
             makedirs(intermdir)
         humanfilenamesorted = path.join(intermdir,humanprefix+".speciesA.namesorted.bam")
         mousefilenamesorted = path.join(intermdir,mouseprefix+".speciesB.namesorted.bam")
-        if not path.isfile(humanfilenamesorted):
-            pysam.sort("-n","-m","2000000000","-o",humanfilenamesorted,humanfilename)
-        if not path.isfile(mousefilenamesorted):
-            pysam.sort("-n","-m","2000000000","-o",mousefilenamesorted,mousefilename)
-   # read in human reads and form a dictionary
-    myHumanFile = pysam.Samfile(humanfilenamesorted, "rb" )
-    myMouseFile = pysam.Samfile(mousefilenamesorted, "rb" )
+        # sort both files at the same time, each in its own process
+        sortjobs = [(humanfilename, humanfilenamesorted, sortthreads, sortmemory),
+                    (mousefilename, mousefilenamesorted, sortthreads, sortmemory)]
+        sortjobs = [job for job in sortjobs if not is_sorted_copy(job[0], job[1])]
+        if sortjobs:
+            pool = Pool(len(sortjobs))
+            try:
+                with metrics.stage('sort'):
+                    pool.starmap(name_sort, sortjobs)
+            finally:
+                pool.close()
+                pool.join()
     if not path.isdir(outputdir):
         makedirs(outputdir)
-    myHumanUniqueFile = pysam.Samfile(path.join(outputdir, humanprefix+".disambiguatedSpeciesA.bam"), "wb", template=myHumanFile)
-    myHumanAmbiguousFile = pysam.Samfile(path.join(outputdir, humanprefix+".ambiguousSpeciesA.bam"), "wb", template=myHumanFile)
-    myMouseUniqueFile = pysam.Samfile(path.join(outputdir, mouseprefix+".disambiguatedSpeciesB.bam"), "wb", template=myMouseFile)
-    myMouseAmbiguousFile = pysam.Samfile(path.join(outputdir, mouseprefix+".ambiguousSpeciesB.bam"), "wb", template=myMouseFile)
-    summaryFile = open(path.join(outputdir,humanprefix+'_summary.txt'),'w')
-
-    #initialise
-    # try:
-    #     nexthumread=myHumanFile.next()
-    #     nextmouread=myMouseFile.next()
-    # except StopIteration:
-    #     print("No reads in one or either of the input files")
-    #     sys.exit(2)
-
-    EOFmouse = EOFhuman = False
-    prevHumID = '-+=RANDOMSTRING=+-'
-    prevMouID = '-+=RANDOMSTRING=+-'
-    while not EOFmouse&EOFhuman:
-        while not (nat_cmp(nexthumread.qname,nextmouread.qname) == 0):
-            # check order between current human and mouse qname (find a point where they're identical, i.e. in sync)
-            while nat_cmp(nexthumread.qname,nextmouread.qname) > 0 and not EOFmouse: # mouse is "behind" human, output to mouse disambiguous
-                myMouseUniqueFile.write(nextmouread)
-                if not nextmouread.qname == prevMouID:
-                    nummou+=1 # increment mouse counter for unique only
-                prevMouID = nextmouread.qname
-                try:
-                    nextmouread=myMouseFile.next()
-                except StopIteration:
-                    EOFmouse=True
-            while nat_cmp(nexthumread.qname,nextmouread.qname) < 0 and not EOFhuman: # human is "behind" mouse, output to human disambiguous
-                myHumanUniqueFile.write(nexthumread)
-                if not nexthumread.qname == prevHumID:
-                    numhum+=1 # increment human counter for unique only
-                prevHumID = nexthumread.qname
-                try:
-                    nexthumread=myHumanFile.next()
-                except StopIteration:
-                    EOFhuman=True
-            if EOFhuman or EOFmouse:
-                break
-        # at this point the read qnames are identical and/or we've reached EOF
-        humlist = list()
-        moulist = list()
-        if nat_cmp(nexthumread.qname,nextmouread.qname) == 0:
-            humlist.append(nexthumread)
-            nexthumread = read_next_reads(myHumanFile, humlist) # read more reads with same qname (the function modifies humlist directly)
-            if not nexthumread:
-                EOFhuman = True
-            moulist.append(nextmouread)
-            nextmouread = read_next_reads(myMouseFile, moulist) # read more reads with same qname (the function modifies moulist directly)
-            if not nextmouread:
-                EOFmouse = True
-
-        # perform comparison to check mouse, human or ambiguous
-        if len(moulist) > 0 and len(humlist) > 0:
-            myAmbiguousness = disambiguate(humlist, moulist, disambalgo)
-            if myAmbiguousness < 0: # mouse
-                nummou+=1 # increment mouse counter
-                for myRead in moulist:
-                    myMouseUniqueFile.write(myRead)
-            elif myAmbiguousness > 0: # human
-                numhum+=1 # increment human counter
-                for myRead in humlist:
-                    myHumanUniqueFile.write(myRead)
-            else: # ambiguous
-                numamb+=1 # increment ambiguous counter
-                for myRead in moulist:
-                    myMouseAmbiguousFile.write(myRead)
-                for myRead in humlist:
-                    myHumanAmbiguousFile.write(myRead)
-        if EOFhuman:
-            #flush the rest of the mouse reads
-            while not EOFmouse:
-                myMouseUniqueFile.write(nextmouread)
-                if not nextmouread.qname == prevMouID:
-                    nummou+=1 # increment mouse counter for unique only
-                prevMouID = nextmouread.qname
-                try:
-                    nextmouread=myMouseFile.next()
-                except StopIteration:
-                    #print("3")
-                    EOFmouse=True
-        if EOFmouse:
-            #flush the rest of the human reads
-            while not EOFhuman:
-                myHumanUniqueFile.write(nexthumread)
-                if not nexthumread.qname == prevHumID:
-                    numhum+=1 # increment human counter for unique only
-                prevHumID = nexthumread.qname
-                try:
-                    nexthumread=myHumanFile.next()
-                except StopIteration:
-                    EOFhuman=True
+    outputfilenames = output_filenames(outputdir, humanprefix, mouseprefix, classification)
+    if (processes > 1 or collated) and not path.isdir(intermdir):
+        makedirs(intermdir)
+    try:
+        if processes > 1:
+            numhum, nummou, numamb, barcodecounts = disambiguate_sharded(
+                humanfilenamesorted, mousefilenamesorted, outputfilenames, disambalgo, processes,
+                path.join(intermdir, humanprefix), threads, writeoptions, collated, engine, barcodesource, metrics,
+                classification)
+        else:
+            numhum, nummou, numamb, barcodecounts = disambiguate_files(
+                humanfilenamesorted, mousefilenamesorted, outputfilenames, disambalgo, threads, writeoptions,
+                collated, path.join(intermdir, humanprefix), engine, barcodesource, metrics, classification)
+    except OutOfOrderError as e:
+        sys.stderr.write("\nERROR in disambiguate.py: "+str(e)+". Name sort them instead of using -c/--collated\n")
+        sys.exit(2)
+    if barcodecounts is not None:
+        barcodecounts.write(path.join(outputdir, humanprefix+'_barcode_counts.csv'))
 
+    summaryFile = open(path.join(outputdir,humanprefix+'_summary.txt'),'w')
     summaryFile.write("sample\tunique species A pairs\tunique species B pairs\tambiguous pairs\n")
     summaryFile.write(humanprefix+"\t"+str(numhum)+"\t"+str(nummou)+"\t"+str(numamb)+"\n")
     summaryFile.close()
-    myHumanFile.close()
-    myMouseFile.close()
-    myHumanUniqueFile.close()
-    myHumanAmbiguousFile.close()
-    myMouseUniqueFile.close()
-    myMouseAmbiguousFile.close()
 
+    runmetrics = metrics.as_dict()
+    runmetrics.update({"sample": humanprefix, "aligner": disambalgo, "engine": engine,
+                       "processes": processes, "threads": threads,
+                       "unique_species_A": numhum, "unique_species_B": nummou, "ambiguous": numamb})
+    with open(path.join(outputdir, humanprefix+'_metrics.json'), 'w') as metricsFile:
+        json.dump(runmetrics, metricsFile, indent=2, sort_keys=True)
 
 def file_exists(fname):
     """Check if a file exists and is non-empty.
@@ -6,11 +6,13 @@ total reads, duplicate reads, UMIs, genes, and percent mitochondrial reads for e
 """
 
 import argparse
+import gzip
 import logging
+import os
 import numpy as np
+import pandas as pd
 import pysam
-from collections import defaultdict
-from functools import partial
+from multiprocessing import Pool
 
 
 def parse_arguments():
@@ -25,84 +27,544 @@ def parse_arguments():
         "--subpool", help="Cellular subpool name", default=None, nargs="?")
     parser.add_argument(
         "--barcode_tag", help="BAM tag containing cell barcode", default="CB")
+    parser.add_argument(
+        "--processes", type=int, default=1,
+        help="Count regions of the indexed bam file in this many processes")
+    parser.add_argument(
+        "--matrix_dir", default=None,
+        help="Also write the UMI counts per barcode and gene to this directory: "
+        "barcodes.tsv.gz, features.tsv.gz and the matrix")
+    parser.add_argument(
+        "--matrix_format", choices=["mtx", "npz"], default="mtx",
+        help="mtx: matrix.mtx.gz (features x barcodes, Matrix Market); "
+        "npz: matrix.npz (barcodes x features, scipy.sparse COO)")
+    parser.add_argument(
+        "--sketch_precision", type=int, choices=range(4, 17), default=None, metavar="4-16",
+        help="Estimate genes and UMIs per barcode with HyperLogLog sketches of "
+        "2^precision registers instead of exact counts. A barcode is counted exactly "
+        "(about 16 bytes per distinct gene and UMI) until it has more than "
+        "3 * 2^precision / 16 of them, e.g. 768 for 12, then it takes 3 * 2^precision "
+        "bytes (12 KB for 12) however many more it gets. Relative standard error of "
+        "those barcodes about 1.04 / sqrt(2^precision), e.g. 6.5%% for 8, 1.6%% for 12. "
+        "Cannot be used with --matrix_dir")
 
     return parser.parse_args()
 
 
-def get_metrics(bam, barcode_tag="CB", subpool=None, genome=None):
+# reads are collected and encoded this many at a time
+CHUNK_SIZE = 1 << 18
+
+
+def add_counts(a, b):
+    """Element-wise sum of two count arrays of possibly different lengths."""
+    if len(a) < len(b):
+        a, b = b, a
+    a = a.copy()
+    a[:len(b)] += b
+    return a
+
+
+def sorted_unique(keys, values=None):
     """
-    Get barcode metrics from bam file; all counts are only for reads overlapping genes.
-    Reported metrics are total counts, UMIs (one UMI counted per unique UMI-gene mapping),
-    duplicate counts, genes, percent mitochondrial reads
+    np.unique of an integer array by sorting (faster than hashing for large
+    arrays). If values are given, also returns the value of the first
+    occurrence of every key.
+    """
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    first = np.concatenate(([True], keys[1:] != keys[:-1])) if len(keys) else np.zeros(0, dtype=bool)
+    if values is None:
+        return keys[first]
+    return keys[first], values[order][first]
+
+
+class UniqueKeys:
+    """
+    Set of integer keys (with an integer value per key) in sorted unique numpy
+    blocks. New blocks are merged once they outgrow the merged keys, so every
+    key is sorted O(log n) times and no Python objects are kept per key.
     """
 
-    # Reads per barcode is a vector of length 2.
-    # [x_mito_reads, mito_reads]
-    reads_per_barcode = defaultdict(partial(np.zeros, 2, dtype=int))
-    genes_per_barcode = defaultdict(set)
-    mito_genes_per_barcode = defaultdict(set)
+    def __init__(self, dtype=np.int64):
+        self.keys = np.zeros(0, dtype=dtype)
+        self.values = np.zeros(0, dtype=np.int64)
+        self.pending = []
 
-    for read in bam:
-        # skip read if not primary alignment (multimapper)
-        if read.flag & 256:
-            continue
+    def add(self, keys, values=None):
+        if values is None:
+            values = np.zeros(len(keys), dtype=np.int64)
+        self.pending.append(sorted_unique(keys, values))
+        if sum(len(k) for k, _ in self.pending) > len(self.keys):
+            self.merge()
 
-        # get barcode; skip read if not present
-        barcode = read.get_tag(barcode_tag)
-        if barcode == "-":
-            continue
+    def merge(self):
+        """Merge all blocks; returns the unique keys and their values."""
+        if self.pending:
+            self.keys, self.values = sorted_unique(np.concatenate([self.keys] + [k for k, _ in self.pending]),
+                                                   np.concatenate([self.values] + [v for _, v in self.pending]))
+            self.pending = []
+        return self.keys, self.values
 
-        # get UMI; skip read if not present
-        umi = read.get_tag("UB")
-        if umi == "-":
-            continue
 
-        # get reads that mapped to genome;
-        # if genome and genome not in read.reference_name:
-        #     continue
+def encode(values, codes, hashes=False):
+    """
+    Integer codes of values, numbering new values in order of appearance in the
+    dictionary codes. The values are factorized as one array, so the
+    dictionary is only consulted once per distinct value. With hashes=True
+    also returns the hash_strings() of the values.
+    """
+    local_codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+    mapping = np.array([codes.setdefault(value, len(codes)) for value in uniques], dtype=np.int64)
+    if hashes:
+        return mapping[local_codes], hash_strings(uniques)[local_codes]
+    return mapping[local_codes]
+
+
+def mix64(h):
+    """splitmix64 finalizer: spreads the bits of uint64 hashes."""
+    h = h ^ (h >> np.uint64(30))
+    h = h * np.uint64(0xbf58476d1ce4e5b9)
+    h = h ^ (h >> np.uint64(27))
+    h = h * np.uint64(0x94d049bb133111eb)
+    return h ^ (h >> np.uint64(31))
+
+
+def hash_strings(values):
+    """
+    64-bit FNV-1a hashes of strings (over their code points), computed one
+    character column at a time on a fixed width unicode array.
+    """
+    chars = np.array(values, dtype=str)
+    if not chars.size or chars.dtype.itemsize == 0:
+        return np.full(len(chars), 0xcbf29ce484222325, dtype=np.uint64)
+    chars = chars.view(np.uint32).reshape(len(chars), -1)
+    h = np.full(len(chars), 0xcbf29ce484222325, dtype=np.uint64)
+    for column in chars.T.astype(np.uint64):
+        # the padding of shorter strings is skipped
+        h = np.where(column != 0, (h ^ column) * np.uint64(0x100000001b3), h)
+    return h
 
-        reads_per_barcode[barcode][0] += 1
 
-        if "chrM" in read.reference_name:
-            reads_per_barcode[barcode][1] += 1
+def umi_keys(barcode_hashes, umis, gene_hashes):
+    """64-bit hashes of (barcode, UMI, gene) triples from the hash_strings() of barcode and gene."""
+    key = mix64(barcode_hashes)
+    key = mix64(key ^ hash_strings(umis))
+    return mix64(key ^ gene_hashes)
 
-        # get gene id; skip read if not present
-        gene_id = read.get_tag("GX")
-        if gene_id == "-":
-            continue
 
-        if "chrM" in read.reference_name:
-            mito_genes_per_barcode[barcode].add(gene_id)
+def leading_zeros(x):
+    """Number of leading zero bits of every element of a uint64 array."""
+    n = np.zeros(len(x), dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        top_zero = (x >> np.uint64(64 - shift)) == 0
+        n += top_zero * shift
+        x = np.where(top_zero, x << np.uint64(shift), x)
+    return n + (x == 0)
+
+
+class HyperLogLogs:
+    """
+    HyperLogLog sketches of distinct counts, n_sketches per row (barcode).
+    Rows start sparse: their values are kept exactly, as unique keys
+    row << 36 | sketch << 34 | top 34 bits of the hash, at about 16 bytes per
+    distinct value. A row with more than n_sketches * 2 ** precision / 16
+    values (where the sketches take less memory) is moved to dense registers,
+    a uint8 array of shape (dense rows, n_sketches, 2 ** precision) that does
+    not grow with the number of distinct values. The relative standard error
+    of a dense estimate is about 1.04 / sqrt(2 ** precision), e.g. 6.5% for
+    precision 8 and 1.6% for 12; counts up to about 2.5 * 2 ** precision are
+    estimated by linear counting, which is more accurate. Sparse counts are
+    exact up to collisions of the 34-bit hashes.
+    """
+
+    HASH_BITS = 34
+
+    def __init__(self, precision, n_sketches):
+        self.precision = precision
+        self.n_sketches = n_sketches
+        self.max_sparse = max(1, n_sketches * (1 << precision) // 16)
+        self.sparse = UniqueKeys(np.uint64)
+        # dense row of every row, -1 while it is sparse
+        self.dense_rows = np.zeros(0, dtype=np.int64)
+        self.registers = np.zeros((0, n_sketches, 1 << precision), dtype=np.uint8)
+
+    def grow(self, n_rows):
+        if n_rows > len(self.dense_rows):
+            self.dense_rows = np.concatenate((self.dense_rows,
+                                              np.full(n_rows - len(self.dense_rows), -1, dtype=np.int64)))
+
+    def add_registers(self, dense_rows, sketch, hashes, hash_bits=64):
+        """Add the top hash_bits bits of hashes (uint64) to the registers of dense_rows."""
+        p = np.uint64(self.precision)
+        hashes = hashes << np.uint64(64 - hash_bits)
+        register = (hashes >> (np.uint64(64) - p)).astype(np.int64)
+        rank = np.minimum(leading_zeros(hashes << p), hash_bits - self.precision) + 1
+        np.maximum.at(self.registers, (dense_rows, sketch, register), rank.astype(np.uint8))
+
+    def add_sparse(self, keys):
+        """Add sparse keys; the ones of dense rows go to their registers."""
+        rows = (keys >> np.uint64(36)).astype(np.int64)
+        self.grow(rows.max() + 1 if len(rows) else 0)
+        dense_rows = self.dense_rows[rows]
+        is_dense = dense_rows >= 0
+        if is_dense.any():
+            dense_keys = keys[is_dense]
+            sketch = (dense_keys >> np.uint64(self.HASH_BITS) & np.uint64(3)).astype(np.int64)
+            self.add_registers(dense_rows[is_dense], sketch, dense_keys & np.uint64((1 << self.HASH_BITS) - 1),
+                               self.HASH_BITS)
+        if not is_dense.all():
+            self.sparse.add(keys[~is_dense])
+        # the sparse rows are counted after every merge of the keys
+        if not self.sparse.pending:
+            self.to_dense_full()
+
+    def to_dense_full(self):
+        """Move the sparse rows with more than max_sparse values to dense registers."""
+        keys, _ = self.sparse.merge()
+        rows = (keys >> np.uint64(36)).astype(np.int64)
+        self.to_dense(np.flatnonzero(np.bincount(rows) > self.max_sparse))
+
+    def to_dense(self, rows):
+        """Move rows to dense registers, with their sparse keys."""
+        rows = rows[self.dense_rows[rows] < 0] if len(rows) else rows
+        if not len(rows):
+            return
+        n_dense = len(self.registers)
+        self.dense_rows[rows] = np.arange(n_dense, n_dense + len(rows))
+        registers = np.zeros((n_dense + len(rows),) + self.registers.shape[1:], dtype=np.uint8)
+        registers[:n_dense] = self.registers
+        self.registers = registers
+
+        keys, values = self.sparse.merge()
+        key_rows = (keys >> np.uint64(36)).astype(np.int64)
+        moved = self.dense_rows[key_rows] >= 0
+        self.sparse.keys, self.sparse.values = keys[~moved], values[~moved]
+        self.add_sparse(keys[moved])
+
+    def add(self, rows, sketch, hashes):
+        """Add 64-bit hashes (uint64) to the sketch number sketch of rows."""
+        if not len(rows):
+            return
+        self.add_sparse(rows.astype(np.uint64) << np.uint64(36) | np.uint64(sketch << self.HASH_BITS)
+                        | hashes >> np.uint64(64 - self.HASH_BITS))
+
+    def update(self, other, row_map):
+        """Merge the sketches of other, its row i into row row_map[i]."""
+        keys, _ = other.sparse.merge()
+        if len(keys):
+            rows = row_map[(keys >> np.uint64(36)).astype(np.int64)].astype(np.uint64)
+            self.add_sparse(rows << np.uint64(36) | keys & np.uint64((1 << 36) - 1))
+
+        other_rows = np.flatnonzero(other.dense_rows[:len(row_map)] >= 0)
+        if len(other_rows):
+            rows = row_map[other_rows]
+            self.grow(rows.max() + 1)
+            self.to_dense(rows)
+            np.maximum.at(self.registers, self.dense_rows[rows], other.registers[other.dense_rows[other_rows]])
+
+    def estimate(self, sketch, n_rows):
+        """Distinct count estimates of the sketch number sketch of the first n_rows rows."""
+        self.grow(n_rows)
+        # whether a row is dense then only depends on its number of values
+        self.to_dense_full()
+        keys, _ = self.sparse.merge()
+        is_sketch = (keys >> np.uint64(self.HASH_BITS) & np.uint64(3)) == sketch
+        estimates = np.bincount((keys[is_sketch] >> np.uint64(36)).astype(np.int64),
+                                minlength=n_rows)[:n_rows].astype(np.float64)
+
+        dense = np.flatnonzero(self.dense_rows[:n_rows] >= 0)
+        registers = self.registers[self.dense_rows[dense], sketch].astype(np.float64)
+        m = registers.shape[1]
+        alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213 / (1 + 1.079 / m))
+        raw = alpha * m * m / np.sum(2.0 ** -registers, axis=1)
+        zeros = np.sum(registers == 0, axis=1)
+        # linear counting for small counts
+        with np.errstate(divide="ignore"):
+            linear = m * np.log(m / zeros)
+        estimates[dense] = np.where((raw <= 2.5 * m) & (zeros > 0), linear, raw)
+        return np.rint(estimates).astype(np.int64)
+
+
+class BarcodeMetrics:
+    """
+    Per barcode read, gene and UMI counts on integer codes. The barcodes, UMIs,
+    gene IDs and reference IDs of the counted reads are collected in chunks of
+    CHUNK_SIZE reads; barcodes and gene IDs are then numbered in order of
+    appearance and the reads and mito reads counted with bincount. The
+    distinct genes are kept as unique packed keys barcode << 33 | mito << 32 | gene,
+    the distinct UMIs as unique 64-bit hashes of (barcode, UMI, gene) with the
+    value barcode << 32 | gene. With a sketch_precision the distinct genes and
+    UMIs are estimated with HyperLogLogs instead, whose memory per barcode is
+    bounded by the size of its sketches.
+    """
+
+    # sketches per barcode
+    GENES, MITO_GENES, UMIS = 0, 1, 2
+
+    def __init__(self, sketch_precision=None):
+        self.sketches = HyperLogLogs(sketch_precision, 3) if sketch_precision else None
+        self.barcodes = {}
+        self.genes = {}
+        self.reads = np.zeros(0, dtype=np.int64)
+        self.mito_reads = np.zeros(0, dtype=np.int64)
+        self.gene_reads = np.zeros(0, dtype=np.int64)
+        self.gene_keys = UniqueKeys()
+        self.umi_keys = UniqueKeys(np.uint64)
+
+    def count_reads(self, reads, mito_contigs, barcode_tag="CB"):
+        """
+        Count the primary, mapped reads with barcode and UMI. mito_contigs
+        holds 1 for every reference ID that is mitochondrial, else 0.
+        """
+        mito_contigs = np.asarray(mito_contigs, dtype=np.int64)
+        barcodes, umis, reference_ids, gene_ids = [], [], [], []
+        for read in reads:
+            # skip read if not primary alignment (multimapper) or unmapped
+            if read.flag & 260:
+                continue
+
+            # get barcode and UMI; skip read if not present
+            try:
+                barcode = read.get_tag(barcode_tag)
+                umi = read.get_tag("UB")
+            except KeyError:
+                continue
+            if barcode == "-" or umi == "-":
+                continue
+
+            # get gene id; "-" if not present
+            try:
+                gene_id = read.get_tag("GX")
+            except KeyError:
+                gene_id = "-"
+
+            barcodes.append(barcode)
+            umis.append(umi)
+            reference_ids.append(read.reference_id)
+            gene_ids.append(gene_id)
+            if len(barcodes) == CHUNK_SIZE:
+                self.add_chunk(barcodes, umis, mito_contigs[reference_ids], gene_ids)
+                barcodes, umis, reference_ids, gene_ids = [], [], [], []
+        self.add_chunk(barcodes, umis, mito_contigs[reference_ids], gene_ids)
+
+    def add_chunk(self, barcodes, umis, mito, gene_ids):
+        if not barcodes:
+            return
+        barcode, barcode_hash = encode(barcodes, self.barcodes, hashes=True)
+        self.reads = add_counts(self.reads, np.bincount(barcode))
+        self.mito_reads = add_counts(self.mito_reads, np.bincount(barcode, weights=mito).astype(np.int64))
+
+        gene_ids = np.array(gene_ids, dtype=object)
+        has_gene = gene_ids != "-"
+        barcode, barcode_hash, mito = barcode[has_gene], barcode_hash[has_gene], mito[has_gene]
+        gene, gene_hash = encode(gene_ids[has_gene], self.genes, hashes=True)
+        self.gene_reads = add_counts(self.gene_reads, np.bincount(barcode))
+        umis = np.array(umis, dtype=object)[has_gene]
+        keys = umi_keys(barcode_hash, umis, gene_hash)
+        if self.sketches:
+            is_mito = mito == 1
+            self.sketches.add(barcode[~is_mito], self.GENES, mix64(gene_hash[~is_mito]))
+            self.sketches.add(barcode[is_mito], self.MITO_GENES, mix64(gene_hash[is_mito]))
+            self.sketches.add(barcode, self.UMIS, keys)
         else:
-            genes_per_barcode[barcode].add(gene_id)
+            self.gene_keys.add(barcode << 33 | mito << 32 | gene)
+            self.umi_keys.add(keys, barcode << 32 | gene)
+
+    def update(self, other):
+        """
+        Add the counts of another BarcodeMetrics. Barcodes new to this one are
+        numbered after the existing ones, in the order of other.
+        """
+        barcode_map = encode(list(other.barcodes), self.barcodes)
+        gene_map = encode(list(other.genes), self.genes)
+        n = len(self.barcodes)
+        for name in ("reads", "mito_reads", "gene_reads"):
+            counts = getattr(other, name)
+            setattr(self, name, add_counts(getattr(self, name),
+                                           np.bincount(barcode_map[:len(counts)], weights=counts,
+                                                       minlength=n).astype(np.int64)))
+        if self.sketches:
+            self.sketches.update(other.sketches, barcode_map)
+            return
+        keys, _ = other.gene_keys.merge()
+        self.gene_keys.add(barcode_map[keys >> 33] << 33 | (keys >> 32 & 1) << 32
+                           | gene_map[keys & 0xffffffff])
+        keys, values = other.umi_keys.merge()
+        self.umi_keys.add(keys, barcode_map[values >> 32] << 32 | gene_map[values & 0xffffffff])
+
+    def umi_matrix(self):
+        """
+        UMIs per barcode and gene in COO form: arrays of barcode codes, gene
+        codes and UMI counts, sorted by barcode and gene.
+        """
+        _, values = self.umi_keys.merge()
+        entries = np.sort(values)
+        first = np.flatnonzero(np.concatenate(([True], entries[1:] != entries[:-1]))[:len(entries)])
+        counts = np.diff(np.append(first, len(entries)))
+        entries = entries[first]
+        return entries >> 32, entries & 0xffffffff, counts
+
+    def table(self, subpool=None):
+        """Rows of the metadata file (lists of strings), barcodes in order of appearance."""
+        n = len(self.barcodes)
+        reads = add_counts(np.zeros(n, dtype=np.int64), self.reads)
+        mito_reads = add_counts(np.zeros(n, dtype=np.int64), self.mito_reads)
+        gene_reads = add_counts(np.zeros(n, dtype=np.int64), self.gene_reads)
+        if self.sketches:
+            genes = self.sketches.estimate(self.GENES, n)
+            mito_genes = self.sketches.estimate(self.MITO_GENES, n)
+            # an estimate may exceed the reads
+            umis = np.minimum(self.sketches.estimate(self.UMIS, n), gene_reads)
+        else:
+            gene_keys, _ = self.gene_keys.merge()
+            _, umi_values = self.umi_keys.merge()
+            mito_genes = np.bincount(gene_keys[(gene_keys >> 32 & 1) == 1] >> 33, minlength=n)
+            genes = np.bincount(gene_keys[(gene_keys >> 32 & 1) == 0] >> 33, minlength=n)
+            umis = np.bincount(umi_values >> 32, minlength=n)
+        percent_mito = np.round(mito_reads / reads * 100, 2)
+
+        barcode_metadata = []
+        for out_barcode, n_reads, n_mito_reads, n_genes, n_mito_genes, percent, n_umis, n_gene_reads in zip(
+                out_barcodes(self.barcodes, subpool), reads.tolist(), mito_reads.tolist(), genes.tolist(),
+                mito_genes.tolist(), percent_mito.tolist(), umis.tolist(), gene_reads.tolist()):
+            barcode_metadata.append(list(map(str, [out_barcode,
+                                                   n_reads,
+                                                   n_reads - n_mito_reads,
+                                                   n_mito_reads,
+                                                   n_genes + n_mito_genes,
+                                                   n_genes, n_mito_genes,
+                                                   percent,
+                                                   n_umis,
+                                                   n_gene_reads - n_umis])))
+        return barcode_metadata
+
+
+def out_barcodes(barcodes, subpool=None):
+    return [barcode + "_" + subpool if subpool else barcode for barcode in barcodes]
+
+
+def write_matrix(metrics, matrix_dir, matrix_format="mtx", subpool=None):
+    """
+    Write the UMI counts per barcode and gene to matrix_dir: barcodes.tsv.gz
+    (in the order of the metadata table), features.tsv.gz and either
+    matrix.mtx.gz (Matrix Market, features x barcodes as Cell Ranger writes
+    it) or matrix.npz (barcodes x features COO matrix in the scipy.sparse
+    save_npz layout).
+    """
+    os.makedirs(matrix_dir, exist_ok=True)
+    barcode, gene, counts = metrics.umi_matrix()
+    n_barcodes, n_genes = len(metrics.barcodes), len(metrics.genes)
+
+    with gzip.open(os.path.join(matrix_dir, "barcodes.tsv.gz"), "wt") as f:
+        f.writelines(barcode + "\n" for barcode in out_barcodes(metrics.barcodes, subpool))
+    with gzip.open(os.path.join(matrix_dir, "features.tsv.gz"), "wt") as f:
+        f.writelines(f"{gene_id}\t{gene_id}\tGene Expression\n" for gene_id in metrics.genes)
+
+    if matrix_format == "npz":
+        np.savez_compressed(os.path.join(matrix_dir, "matrix.npz"), format=b"coo",
+                            shape=np.array([n_barcodes, n_genes]),
+                            row=barcode.astype(np.int32), col=gene.astype(np.int32), data=counts)
+        return
 
-    # create list with barcodes and associated metrics
-    barcode_metadata = []
-    for barcode, reads_vector in reads_per_barcode.items():
-        # Reminder that reads_vector is [total_reads, mito_reads].
-        genes = len(genes_per_barcode[barcode])
-        mito_genes = len(mito_genes_per_barcode[barcode])
-        fraction_mitochondrial_reads = round(
-            reads_vector[1]/reads_vector[0] * 100, 2)
-        out_barcode = barcode + "_" + subpool if subpool else barcode
+    with gzip.open(os.path.join(matrix_dir, "matrix.mtx.gz"), "wt") as f:
+        f.write("%%MatrixMarket matrix coordinate integer general\n")
+        f.write(f"{n_genes} {n_barcodes} {len(counts)}\n")
+        # 1-based, one column (barcode) after the other
+        np.savetxt(f, np.column_stack((gene + 1, barcode + 1, counts)), fmt="%d")
 
-        metrics = list(map(str, [out_barcode,
-                                 reads_vector[0],
-                                 reads_vector[0]-reads_vector[1],
-                                 reads_vector[1],
-                                 genes+mito_genes,
-                                 genes, mito_genes,
-                                 fraction_mitochondrial_reads]))
 
-        barcode_metadata.append(metrics)
+def mito_contigs(bam):
+    """1 for every reference of the BAM header that is mitochondrial (chrM), else 0."""
+    return [1 if "chrM" in name else 0 for name in bam.references]
 
-    return barcode_metadata
+
+def balanced_regions(bam, n_regions):
+    """
+    Split the contigs with mapped reads into about n_regions regions (contig,
+    start, end) of the same number of reads, in the order of the BAM file.
+    The mapped reads per contig come from the index; contigs with more than
+    their share are cut into equally long pieces.
+    """
+    mapped = [(stat.contig, stat.mapped) for stat in bam.get_index_statistics() if stat.mapped]
+    share = max(1, sum(n for _, n in mapped) // n_regions)
+    regions = []
+    for contig, n in mapped:
+        length = bam.get_reference_length(contig)
+        n_pieces = min(length, -(-n // share))
+        step = -(-length // n_pieces)
+        regions.extend((contig, start, min(start + step, length)) for start in range(0, length, step))
+    return regions
+
+
+def count_regions(bam_file, bai_file, regions, barcode_tag="CB", sketch_precision=None):
+    """
+    BarcodeMetrics of the reads that start in regions (contig, start, end),
+    read through the index.
+    """
+    bam = pysam.AlignmentFile(bam_file, "rb", index_filename=bai_file)
+    mito = mito_contigs(bam)
+    metrics = BarcodeMetrics(sketch_precision)
+    for contig, start, end in regions:
+        # fetch also gives the reads that start in the previous region
+        reads = (read for read in bam.fetch(contig, start, end) if read.reference_start >= start)
+        metrics.count_reads(reads, mito, barcode_tag)
+    if not metrics.sketches:
+        metrics.gene_keys.merge()
+        metrics.umi_keys.merge()
+    bam.close()
+    return metrics
+
+
+def partial_metrics(args):
+    """count_regions for Pool.imap."""
+    return count_regions(*args)
+
+
+def get_metrics_parallel(bam_file, bai_file, processes, barcode_tag="CB", subpool=None,
+                         matrix_dir=None, matrix_format="mtx", sketch_precision=None):
+    """
+    get_metrics in a pool of processes, each counting balanced regions of the
+    indexed BAM file. The partial counts are merged in the order of the
+    regions, so the table is the same as the one of get_metrics.
+    """
+    bam = pysam.AlignmentFile(bam_file, "rb", index_filename=bai_file)
+    # a few regions per process, so that a slow region does not hold up the pool
+    regions = balanced_regions(bam, 4 * processes)
+    bam.close()
+
+    metrics = BarcodeMetrics(sketch_precision)
+    with Pool(processes) as pool:
+        for partial in pool.imap(partial_metrics, [(bam_file, bai_file, [region], barcode_tag,
+                                                    sketch_precision) for region in regions]):
+            metrics.update(partial)
+    if matrix_dir:
+        write_matrix(metrics, matrix_dir, matrix_format, subpool)
+    return metrics.table(subpool)
+
+
+def get_metrics(bam, barcode_tag="CB", subpool=None, genome=None, matrix_dir=None, matrix_format="mtx",
+                sketch_precision=None):
+    """
+    Get barcode metrics from bam file; all counts are only for reads overlapping genes.
+    Reported metrics are total counts, UMIs (one UMI counted per unique UMI-gene mapping),
+    duplicate counts, genes, percent mitochondrial reads. Duplicate counts are the reads
+    with a gene that repeat the UMI and gene of an earlier read of the barcode.
+    If matrix_dir is given, the UMI counts per barcode and gene are also written
+    there (see write_matrix). With sketch_precision, genes and UMIs are
+    HyperLogLog estimates (see HyperLogLogs)
+    """
+    metrics = BarcodeMetrics(sketch_precision)
+    metrics.count_reads(bam, mito_contigs(bam), barcode_tag)
+    if matrix_dir:
+        write_matrix(metrics, matrix_dir, matrix_format, subpool)
+    return metrics.table(subpool)
 
 
 def write_metadata_file(barcode_metadata, output_file):
     fields = ["barcode", "total_counts", "reads_non_mito",
               "reads_mito", "genes", "genes_non_mito",
-              "genes_mito", "percent_mitochondrial"]
+              "genes_mito", "percent_mitochondrial",
+              "umis", "duplicate_counts"]
 
     with open(output_file, "w") as f:
         # write header
@@ -120,16 +582,29 @@ def main():
     subpool = args.subpool
     barcode_tag = args.barcode_tag
     barcode_metadata_file = args.barcode_metadata_file
-
-    # load bam file
-    # bam = pysam.AlignmentFile(bam_file, "rb", index_filename=bai_file)
-    bam = pysam.AlignmentFile(bam_file, "rb")
+    if args.matrix_dir and args.sketch_precision:
+        raise ValueError("The UMI matrix needs exact counts, it cannot be written with --sketch_precision")
 
     # get metrics for each barcode
-    barcode_metadata = get_metrics(bam,
-                                   barcode_tag,
-                                   subpool,
-                                   genome=args.genome)
+    if args.processes > 1:
+        barcode_metadata = get_metrics_parallel(bam_file,
+                                                bai_file,
+                                                args.processes,
+                                                barcode_tag,
+                                                subpool,
+                                                args.matrix_dir,
+                                                args.matrix_format,
+                                                args.sketch_precision)
+    else:
+        # load bam file
+        bam = pysam.AlignmentFile(bam_file, "rb", index_filename=bai_file)
+        barcode_metadata = get_metrics(bam,
+                                       barcode_tag,
+                                       subpool,
+                                       genome=args.genome,
+                                       matrix_dir=args.matrix_dir,
+                                       matrix_format=args.matrix_format,
+                                       sketch_precision=args.sketch_precision)
 
     # write metadata file
     write_metadata_file(barcode_metadata, barcode_metadata_file)
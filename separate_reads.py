@@ -1,7 +1,15 @@
 import pandas as pd
 import pysam
 import argparse
+import gzip
+import json
 import logging
+import os
+import sys
+from itertools import islice, zip_longest
+from multiprocessing import Pool
+from barcode_counts import BarcodeSpeciesCounts, get_barcode_function
+from disambiguate import OutOfOrderError, lockstep_groups
 
 logging.basicConfig(
     format="%(asctime)s %(levelname)-8s %(message)s",
@@ -19,120 +27,370 @@ def parse_args():
                         help="BAM file containing reads that mapped to mouse genome")
     parser.add_argument('--out_dir', type=str, default=None)
     parser.add_argument('--out_name', type=str, default=None)
+    parser.add_argument('--barcode_source', type=str, default=None,
+                        help="Also count human/mouse/ambiguous reads per cell barcode, "
+                        "taking the barcode from the read name ('qname') or from a BAM tag (e.g. CB). "
+                        "Writes <out_name>_barcode_counts.csv")
+    parser.add_argument('--compress', action='store_true',
+                        help="Write gzip compressed read name lists (<out_name>_human.csv.gz etc.)")
+    parser.add_argument('--grouped', action='store_true',
+                        help="The BAM files list the read names in the same order (name sorted, "
+                        "or the FASTQ order of the aligner) and may hold all alignments of a read, "
+                        "including reads missing from the other file. "
+                        "Each read name is scored by the sum of the best AS of its mates")
+    parser.add_argument('--atac', action='store_true',
+                        help="Write the reads to <out_name>_human.bam, <out_name>_mouse.bam, "
+                        "<out_name>_human_ambiguous.bam and <out_name>_mouse_ambiguous.bam "
+                        "instead of read name lists")
+    parser.add_argument('--processes', type=int, default=1,
+                        help="With --atac: classify ranges of the BAM files in this many processes. "
+                        "The record offsets of the ranges are kept in <out_dir>/<out_name>_human.ridx "
+                        "and <out_dir>/<out_name>_mouse.ridx")
+    parser.add_argument('--range_size', type=int, default=1000000,
+                        help="Records per range with --processes")
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.atac and args.grouped and args.processes > 1:
+        parser.error('--grouped BAM files cannot be split into record ranges, use --processes 1')
+    return args
 
 
-def separate_atac(human_bam_file, mouse_bam_file, out_dir, out_name):
-    human_bam = pysam.AlignmentFile(human_bam_file, mode='rb')
-    mouse_bam = pysam.AlignmentFile(mouse_bam_file, mode='rb')
+def read_pairs(human_bam, mouse_bam, counts, grouped=False, bucket_prefix=None):
+    """
+    Pair up the reads of two BAM files, yielding (human reads, mouse reads).
 
-    out_bam1 = pysam.AlignmentFile(f"{out_dir}/{out_name}_human.bam",
-                                   "wb", template=human_bam)
-    out_bam2 = pysam.AlignmentFile(f"{out_dir}/{out_name}_mouse.bam",
-                                   "wb", template=mouse_bam)
-    out_bam3 = pysam.AlignmentFile(f"{out_dir}/{out_name}_human_ambiguous.bam",
-                                   "wb", template=human_bam)
-    out_bam4 = pysam.AlignmentFile(f"{out_dir}/{out_name}_mouse_ambiguous.bam",
-                                   "wb", template=mouse_bam)
+    By default both files hold one record per read in the same order and every
+    pair is two single reads; if one file is longer, its remaining records are
+    only counted. With grouped=True both files may hold any number of records
+    per read name, e.g. both mates and secondary alignments, and read names
+    missing from the other file. The records of a read name must be adjacent
+    and both files must list the read names in the same order, e.g. name
+    sorted or straight from the aligner (see disambiguate.lockstep_groups; if
+    the orders differ, the reads are hash bucketed in files bucket_prefix.*, or
+    OutOfOrderError is raised once a read name turns up in the second file
+    after it was already yielded as found in one file only).
+    All records of a read name are yielded together and a read name present in
+    one file only comes with an empty list for the other file. counts gets the number of records per file ('human', 'mouse')
+    and of 'mismatched' pairs: pairs with different read names, or read names
+    in one file only when grouped.
+    """
+    if grouped:
+        for human_group, mouse_group in lockstep_groups(human_bam, mouse_bam, bucket_prefix,
+                                                        label='separate_reads.py'):
+            counts['human'] += len(human_group)
+            counts['mouse'] += len(mouse_group)
+            if not human_group or not mouse_group:
+                counts['mismatched'] += 1
+            yield human_group, mouse_group
+        return
 
-    n_human, n_mouse, n_ambiguous = 0, 0, 0
-    for human_read, mouse_read in zip(human_bam,
-                                      mouse_bam):
+    for human_read, mouse_read in zip_longest(human_bam, mouse_bam):
+        # one file is longer, only count its remaining reads
+        if human_read is None or mouse_read is None:
+            if human_read is not None:
+                counts['human'] += 1
+            if mouse_read is not None:
+                counts['mouse'] += 1
+            continue
+
+        counts['human'] += 1
+        counts['mouse'] += 1
         if human_read.qname != mouse_read.qname:
             logging.error('Reads have different name!')
+            counts['mismatched'] += 1
+        yield [human_read], [mouse_read]
 
-        # compare alignment score
+
+def alignment_score(reads):
+    """
+    Score of the records of one read name: the sum over the mates of the best
+    AS of each mate. A mate without AS tag (e.g. unmapped) scores -10000.
+    """
+    if len(reads) == 1:
         try:
-            human_as = human_read.get_tag('AS')
+            return reads[0].get_tag('AS')
         except KeyError:
-            human_as = -10000
+            return -10000
 
+    best = {}
+    for read in reads:
         try:
-            mouse_as = mouse_read.get_tag('AS')
+            score = read.get_tag('AS')
         except KeyError:
-            mouse_as = -10000
+            score = -10000
+        mate = 1 if read.is_read1 else 2 if read.is_read2 else 0
+        if mate not in best or score > best[mate]:
+            best[mate] = score
+    return sum(best.values())
+
+
+def classify(human_group, mouse_group):
+    """
+    Species of a read name: 0 (human), 1 (mouse) or 2 (ambiguous). A read name
+    found in one file only belongs to that species.
+    """
+    if not mouse_group:
+        return 0
+    if not human_group:
+        return 1
 
-        if human_as > mouse_as:
+    # compare alignment score
+    human_as = alignment_score(human_group)
+    mouse_as = alignment_score(mouse_group)
+    if human_as > mouse_as:
+        return 0
+    elif human_as < mouse_as:
+        return 1
+    else:
+        return 2
+
+
+def write_atac_pairs(pairs, out_bams):
+    """
+    Write the reads of every (human reads, mouse reads) pair to out_bams (human,
+    mouse, human ambiguous and mouse ambiguous BAM files) by their species.
+    Returns the numbers of human, mouse and ambiguous reads.
+    """
+    out_bam1, out_bam2, out_bam3, out_bam4 = out_bams
+    n_human, n_mouse, n_ambiguous = 0, 0, 0
+    for human_group, mouse_group in pairs:
+        species = classify(human_group, mouse_group)
+        if species == 0:
             # write to human BAM file
-            out_bam1.write(human_read)
+            for read in human_group:
+                out_bam1.write(read)
             n_human += 1
-        elif human_as < mouse_as:
+        elif species == 1:
             # write to mouse BAM file
-            out_bam2.write(mouse_read)
+            for read in mouse_group:
+                out_bam2.write(read)
             n_mouse += 1
         else:
             # write to ambiguous BAM file
-            out_bam3.write(human_read)
-            out_bam4.write(mouse_read)
+            for read in human_group:
+                out_bam3.write(read)
+            for read in mouse_group:
+                out_bam4.write(read)
             n_ambiguous += 1
 
     return n_human, n_mouse, n_ambiguous
 
 
-def separate(human_bam_file, mouse_bam_file, out_dir, out_name):
+def atac_out_files(out_dir, out_name):
+    return [f"{out_dir}/{out_name}_{suffix}.bam"
+            for suffix in ('human', 'mouse', 'human_ambiguous', 'mouse_ambiguous')]
+
+
+def open_atac_out_bams(out_files, human_bam, mouse_bam):
+    return [pysam.AlignmentFile(out_file, "wb", template=template)
+            for out_file, template in zip(out_files, (human_bam, mouse_bam, human_bam, mouse_bam))]
+
+
+def separate_atac(human_bam_file, mouse_bam_file, out_dir, out_name,
+                  grouped=False, processes=1, range_size=1000000):
+    """
+    Split the reads of two BAM files into human, mouse and ambiguous BAM files
+    (see read_pairs for the input layouts). With processes > 1 the files are
+    classified in ranges of range_size records, see separate_atac_parallel.
+    Returns the numbers of human, mouse and ambiguous reads, of records in the
+    human and mouse BAM files and of mismatched pairs.
+    """
+    if processes > 1:
+        if grouped:
+            raise ValueError('Grouped BAM files cannot be split into record ranges')
+        return separate_atac_parallel(human_bam_file, mouse_bam_file, out_dir, out_name,
+                                      processes, range_size)
+
     human_bam = pysam.AlignmentFile(human_bam_file, mode='rb')
     mouse_bam = pysam.AlignmentFile(mouse_bam_file, mode='rb')
+    out_bams = open_atac_out_bams(atac_out_files(out_dir, out_name), human_bam, mouse_bam)
 
-    human_reads, mouse_reads, ambiguous_reads = [], [], []
-    
-    for human_read, mouse_read in zip(human_bam,
-                                      mouse_bam):
-        if human_read.qname != mouse_read.qname:
-            logging.error('Reads have different name!')
-        
+    counts = {'human': 0, 'mouse': 0, 'mismatched': 0}
+    n_species = write_atac_pairs(read_pairs(human_bam, mouse_bam, counts, grouped, f'{out_dir}/{out_name}'),
+                                 out_bams)
 
-        # compare alignment score
-        try:
-            human_as = human_read.get_tag('AS')
-        except KeyError:
-            human_as = -10000
-            
-        try:
-            mouse_as = mouse_read.get_tag('AS')
-        except KeyError:
-            mouse_as = -10000
+    for out_bam in out_bams:
+        out_bam.close()
+
+    return (*n_species, counts['human'], counts['mouse'], counts['mismatched'])
+
+
+def record_offsets(bam_file, range_size, index_file):
+    """
+    BGZF virtual offsets of the records 0, range_size, 2 * range_size, ... of a
+    BAM file and its number of records. They are kept in the side index
+    index_file and only recomputed if the BAM file or range_size changed.
+    """
+    stat = os.stat(os.path.realpath(bam_file))
+    stamp = {'path': os.path.realpath(bam_file), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+             'range_size': range_size}
+    if os.path.exists(index_file):
+        with open(index_file) as f:
+            index = json.load(f)
+        if index['stamp'] == stamp:
+            return index['offsets'], index['records']
+
+    bam = pysam.AlignmentFile(bam_file, mode='rb')
+    offsets = [bam.tell()]
+    n_records = 0
+    for n_records, _ in enumerate(bam, 1):
+        if n_records % range_size == 0:
+            offsets.append(bam.tell())
+    bam.close()
+    # no range starts at the end of the file
+    offsets = offsets[:(n_records + range_size - 1) // range_size]
+
+    with open(index_file, 'w') as f:
+        json.dump({'stamp': stamp, 'offsets': offsets, 'records': n_records}, f)
+    return offsets, n_records
 
-        if human_as > mouse_as:
-            human_reads.append(human_read.qname)
-        elif human_as < mouse_as:
-            mouse_reads.append(mouse_read.qname)
-        else:
-            ambiguous_reads.append(human_read.qname)
 
-    df_human = pd.DataFrame({'read_name': human_reads})
-    df_mouse = pd.DataFrame({'read_name': mouse_reads})
-    df_ambiguous = pd.DataFrame({'read_name': ambiguous_reads})
+def separate_atac_range(human_bam_file, mouse_bam_file, human_offset, mouse_offset,
+                        n_records, out_files):
+    """Classify n_records read pairs starting at the given virtual offsets into out_files."""
+    human_bam = pysam.AlignmentFile(human_bam_file, mode='rb')
+    mouse_bam = pysam.AlignmentFile(mouse_bam_file, mode='rb')
+    human_bam.seek(human_offset)
+    mouse_bam.seek(mouse_offset)
+    out_bams = open_atac_out_bams(out_files, human_bam, mouse_bam)
+
+    counts = {'human': 0, 'mouse': 0, 'mismatched': 0}
+    n_species = write_atac_pairs(read_pairs(islice(human_bam, n_records), islice(mouse_bam, n_records),
+                                            counts), out_bams)
+
+    for out_bam in out_bams:
+        out_bam.close()
+
+    return (*n_species, counts['mismatched'])
+
+
+def separate_atac_parallel(human_bam_file, mouse_bam_file, out_dir, out_name,
+                           processes, range_size=1000000):
+    """
+    separate_atac for two BAM files with one record per read in the same order,
+    in a pool of processes: both files are cut into ranges of range_size
+    records (at the virtual offsets of record_offsets), the ranges are
+    classified independently and the per range BAM files are concatenated in
+    order, so the outputs are the same as those of separate_atac.
+    """
+    with Pool(processes) as pool:
+        # both indexes are built at the same time
+        ((human_offsets, n_reads_human),
+         (mouse_offsets, n_reads_mouse)) = pool.starmap(record_offsets, [
+            (human_bam_file, range_size, f'{out_dir}/{out_name}_human.ridx'),
+            (mouse_bam_file, range_size, f'{out_dir}/{out_name}_mouse.ridx')])
 
-    df_human.to_csv(f'{out_dir}/{out_name}_human.csv',
-                    index=False, header=False, sep='\t')
-    df_mouse.to_csv(f'{out_dir}/{out_name}_mouse.csv',
-                    index=False, header=False, sep='\t')
-    df_ambiguous.to_csv(
-        f'{out_dir}/{out_name}_ambiguous.csv',
-        index=False, header=False, sep='\t')
+        out_files = atac_out_files(out_dir, out_name)
+        n_records = min(n_reads_human, n_reads_mouse)
+        range_files = [atac_out_files(out_dir, f'{out_name}.range{i}')
+                       for i in range(min(len(human_offsets), len(mouse_offsets)))]
+        if not range_files:
+            # nothing to split, just write the (empty) output files
+            return separate_atac(human_bam_file, mouse_bam_file, out_dir, out_name)
 
-    return len(human_reads), len(mouse_reads), len(ambiguous_reads)
+        results = pool.starmap(separate_atac_range,
+                               [(human_bam_file, mouse_bam_file, human_offsets[i], mouse_offsets[i],
+                                 min(range_size, n_records - i * range_size), range_files[i])
+                                for i in range(len(range_files))])
+
+    # samtools cat copies the compressed blocks of the ranges
+    for i, out_file in enumerate(out_files):
+        pysam.cat('-o', out_file, *[files[i] for files in range_files])
+    for files in range_files:
+        for range_file in files:
+            os.remove(range_file)
+
+    n_human, n_mouse, n_ambiguous, n_mismatched = [sum(column) for column in zip(*results)]
+    return n_human, n_mouse, n_ambiguous, n_reads_human, n_reads_mouse, n_mismatched
+
+
+def open_read_list(filename, compress=False):
+    """
+    Open a read name list for writing, one name per line. Names are written
+    as they are classified, through a large buffer or a gzip stream.
+    """
+    if compress:
+        return gzip.open(filename + '.gz', 'wt', compresslevel=6)
+    return open(filename, 'w', buffering=1 << 20)
+
+
+def separate(human_bam_file, mouse_bam_file, out_dir, out_name,
+             barcode_source=None, compress=False, grouped=False):
+    """
+    Classify the reads of two BAM files in a single pass (see read_pairs for
+    the input layouts). Returns the numbers of human, mouse and ambiguous
+    reads, of records in the human and mouse BAM files and of mismatched pairs.
+    """
+    human_bam = pysam.AlignmentFile(human_bam_file, mode='rb')
+    mouse_bam = pysam.AlignmentFile(mouse_bam_file, mode='rb')
+
+    read_lists = [open_read_list(f'{out_dir}/{out_name}_{species}.csv', compress)
+                  for species in ('human', 'mouse', 'ambiguous')]
+    n_species = [0, 0, 0]
+    counts = {'human': 0, 'mouse': 0, 'mismatched': 0}
+
+    # per barcode counts of human (0), mouse (1) and ambiguous (2) reads
+    if barcode_source:
+        barcode_counts = BarcodeSpeciesCounts(('human', 'mouse', 'ambiguous'))
+        get_barcode = get_barcode_function(barcode_source)
+
+    for human_group, mouse_group in read_pairs(human_bam, mouse_bam, counts, grouped, f'{out_dir}/{out_name}'):
+        species = classify(human_group, mouse_group)
+        read = mouse_group[0] if species == 1 else human_group[0]
+        read_lists[species].write(read.qname + '\n')
+        n_species[species] += 1
+
+        if barcode_source:
+            barcode = get_barcode((human_group or mouse_group)[0])
+            if barcode is not None:
+                barcode_counts.add(barcode, species)
+
+    for read_list in read_lists:
+        read_list.close()
+
+    if barcode_source:
+        barcode_counts.write(f'{out_dir}/{out_name}_barcode_counts.csv')
+
+    return (*n_species, counts['human'], counts['mouse'], counts['mismatched'])
 
 
 def main():
     args = parse_args()
 
-    human_bam = pysam.AlignmentFile(args.human_bam, mode='rb')
-    mouse_bam = pysam.AlignmentFile(args.mouse_bam, mode='rb')
+    logging.info(f'Classifing reads')
+    try:
+        if args.atac:
+            (n_human, n_mouse, n_ambiguous,
+             num_reads_human, num_reads_mouse, n_mismatched) = separate_atac(human_bam_file=args.human_bam,
+                                                                             mouse_bam_file=args.mouse_bam,
+                                                                             out_dir=args.out_dir,
+                                                                             out_name=args.out_name,
+                                                                             grouped=args.grouped,
+                                                                             processes=args.processes,
+                                                                             range_size=args.range_size)
+        else:
+            (n_human, n_mouse, n_ambiguous,
+             num_reads_human, num_reads_mouse, n_mismatched) = separate(human_bam_file=args.human_bam,
+                                                                        mouse_bam_file=args.mouse_bam,
+                                                                        out_dir=args.out_dir,
+                                                                        out_name=args.out_name,
+                                                                        barcode_source=args.barcode_source,
+                                                                        compress=args.compress,
+                                                                        grouped=args.grouped)
+    except OutOfOrderError as e:
+        logging.error(f'{e}; name sort both BAM files')
+        sys.exit(1)
 
     # check if they have same number of reads
-    num_reads_human = sum(1 for _ in human_bam)
-    num_reads_mouse = sum(1 for _ in mouse_bam)
-
     logging.info(f'Number of reads in human bam file: {num_reads_human}')
     logging.info(f'Number of reads in mouse bam file: {num_reads_mouse}')
-
-    logging.info(f'Classifing reads')
-    n_human, n_mouse, n_ambiguous = separate(human_bam_file=args.human_bam,
-                                             mouse_bam_file=args.mouse_bam,
-                                             out_dir=args.out_dir,
-                                             out_name=args.out_name)
+    if args.grouped:
+        logging.info(f'Number of read names found in one bam file only: {n_mismatched}')
+    else:
+        if num_reads_human != num_reads_mouse:
+            logging.error('BAM files have different numbers of reads, '
+                          'only the first {} were classified'.format(min(num_reads_human, num_reads_mouse)))
+        logging.info(f'Number of read pairs with different names: {n_mismatched}')
 
     logging.info(f'Number of human reads: {n_human}')
     logging.info(f'Number of mouse reads: {n_mouse}')
@@ -0,0 +1,204 @@
+import pandas as pd
+import pysam
+import argparse
+import gzip
+import logging
+from collections import deque
+from itertools import groupby
+from operator import attrgetter
+from barcode_counts import BarcodeSpeciesCounts, barcode_from_qname, get_barcode_function
+from separate_reads import atac_out_files, classify, open_atac_out_bams
+
+logging.basicConfig(
+    format="%(asctime)s %(levelname)-8s %(message)s",
+    level=logging.INFO,
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Splits reads into human, mouse and ambiguous in one pass: writes the species '
+        'BAM files, the species FASTQ files and the per barcode counts')
+    parser.add_argument('--human_bam', type=str, default=None,
+                        help="BAM file containing reads that mapped to human genome, "
+                        "in the order of the FASTQ files (e.g. straight from the aligner)")
+    parser.add_argument('--mouse_bam', type=str, default=None,
+                        help="BAM file containing reads that mapped to mouse genome, "
+                        "in the order of the FASTQ files")
+    parser.add_argument('--fastq', type=str, nargs='+', default=None,
+                        help="The FASTQ files the BAM files were aligned from (e.g. R1 and R2)")
+    parser.add_argument('--out_dir', type=str, default=None)
+    parser.add_argument('--out_name', type=str, default=None)
+    parser.add_argument('--barcode_source', type=str, default='qname',
+                        help="Take the barcode from the read name ('qname') or from a BAM tag (e.g. CB)")
+    parser.add_argument('--compression_level', type=int, default=6,
+                        help="gzip compression level of the FASTQ files")
+
+    return parser.parse_args()
+
+
+def fastq_name(header):
+    """Read name of a FASTQ header line as it appears in the BAM files."""
+    name = header[1:].split(None, 1)[0]
+    if name.endswith('/1') or name.endswith('/2'):
+        name = name[:-2]
+    return name
+
+
+def bam_groups(bam):
+    """Yield (read name, records) for the consecutive records of each read name."""
+    for name, reads in groupby(bam, key=attrgetter('query_name')):
+        yield name, list(reads)
+
+
+class RecentNames:
+    """The last size read names added to it, for membership tests."""
+
+    def __init__(self, size):
+        self.size = size
+        self.names = set()
+        self.order = deque()
+
+    def add(self, name):
+        self.names.add(name)
+        self.order.append(name)
+        if len(self.order) > self.size:
+            self.names.discard(self.order.popleft())
+
+    def __contains__(self, name):
+        return name in self.names
+
+
+def separate_species(human_bam_file, mouse_bam_file, fastq_files, out_dir, out_name,
+                     barcode_source='qname', compression_level=6, window=1 << 16):
+    """
+    Walk the FASTQ files and both BAM files together. The FASTQ files give the
+    order of the read names; the records of a read name are taken from a BAM
+    file if they come next in it, so reads that did not align to a species may
+    be missing from its BAM file. Every read name is classified once (see
+    separate_reads.classify) and its records and FASTQ entries are written to
+    the files of its species.
+
+    The counts are in the units of separate_reads.py, which sees one record
+    per mate: every read name counts once per FASTQ file, and a read name that
+    aligned to neither species counts as ambiguous (nothing is written for
+    it). Unlike separate_reads.py, a read name is classified once from all its
+    records (see separate_reads.classify), so the counts differ where
+    separate_reads.py would give the mates of a read different species.
+
+    A ValueError is raised as soon as a BAM file turns out not to be in the
+    order of the FASTQ files: its next read name is one of the last window
+    read names of the FASTQ files that were missing from it, or it holds
+    records after the FASTQ files ended.
+    Returns the numbers of human, mouse and ambiguous reads and the number of
+    read names that aligned to neither species (included in ambiguous).
+    """
+    human_bam = pysam.AlignmentFile(human_bam_file, mode='rb')
+    mouse_bam = pysam.AlignmentFile(mouse_bam_file, mode='rb')
+    out_bams = open_atac_out_bams(atac_out_files(out_dir, out_name), human_bam, mouse_bam)
+
+    in_fastqs = [gzip.open(f, 'rt') for f in fastq_files]
+    out_fastqs = [[gzip.open(f'{out_dir}/{out_name}_{species}_R{i + 1}.fastq.gz', 'wt',
+                             compresslevel=compression_level) for i in range(len(fastq_files))]
+                  for species in ('human', 'mouse')]
+
+    barcode_counts = BarcodeSpeciesCounts(('human', 'mouse', 'ambiguous'))
+    get_barcode = get_barcode_function(barcode_source)
+
+    n_species = [0, 0, 0]
+    n_unaligned = 0
+    n_mates = len(fastq_files)
+    bam_files = (human_bam_file, mouse_bam_file)
+    groups = [bam_groups(human_bam), bam_groups(mouse_bam)]
+    next_groups = [next(groups[0], (None, [])), next(groups[1], (None, []))]
+    # recent read names of the FASTQ files missing from the human and the mouse BAM file
+    missing = [RecentNames(window), RecentNames(window)]
+    # every entry holds the four lines of a record of each FASTQ file
+    for entries in zip(*[zip(f, f, f, f) for f in in_fastqs]):
+        name = fastq_name(entries[0][0])
+        matched = [[], []]
+        for i in (0, 1):
+            if next_groups[i][0] != name:
+                missing[i].add(name)
+                continue
+            matched[i] = next_groups[i][1]
+            next_groups[i] = next(groups[i], (None, []))
+            if next_groups[i][0] in missing[i]:
+                raise ValueError(f'{bam_files[i]} holds read {next_groups[i][0]} after {name}, '
+                                 'which follows it in the FASTQ files; the BAM files must be in the '
+                                 'order of the FASTQ files')
+        human_group, mouse_group = matched
+        if not human_group and not mouse_group:
+            n_unaligned += 1
+            n_species[2] += n_mates
+            barcode = barcode_from_qname(name) if barcode_source == 'qname' else None
+            if barcode is not None:
+                barcode_counts.add(barcode, 2, n_mates)
+            continue
+
+        species = classify(human_group, mouse_group)
+        n_species[species] += n_mates
+        if species == 0:
+            for read in human_group:
+                out_bams[0].write(read)
+        elif species == 1:
+            for read in mouse_group:
+                out_bams[1].write(read)
+        else:
+            for read in human_group:
+                out_bams[2].write(read)
+            for read in mouse_group:
+                out_bams[3].write(read)
+
+        # same records as split_fastq_file.py writes
+        if species != 2:
+            for out_fastq, (header, seq, _, qual) in zip(out_fastqs[species], entries):
+                out_fastq.write(header + seq + '+\n' + qual)
+
+        barcode = get_barcode((human_group or mouse_group)[0])
+        if barcode is not None:
+            barcode_counts.add(barcode, species, n_mates)
+
+    for bam_file, (name, _) in zip(bam_files, next_groups):
+        if name is not None:
+            raise ValueError(f'{bam_file} holds read {name} that is not in the FASTQ files or not '
+                             'in their order; the BAM files must be in the order of the FASTQ files')
+
+    for f in out_bams + out_fastqs[0] + out_fastqs[1] + in_fastqs:
+        f.close()
+    barcode_counts.write(f'{out_dir}/{out_name}_barcode_counts.csv')
+
+    return (*n_species, n_unaligned)
+
+
+def main():
+    args = parse_args()
+
+    logging.info('Classifing reads')
+    n_human, n_mouse, n_ambiguous, n_unaligned = separate_species(
+        human_bam_file=args.human_bam,
+        mouse_bam_file=args.mouse_bam,
+        fastq_files=args.fastq,
+        out_dir=args.out_dir,
+        out_name=args.out_name,
+        barcode_source=args.barcode_source,
+        compression_level=args.compression_level)
+
+    logging.info(f'Number of human reads: {n_human}')
+    logging.info(f'Number of mouse reads: {n_mouse}')
+    logging.info(f'Number of ambiguous reads: {n_ambiguous}')
+    logging.info(f'Number of read names not aligned to either genome (counted as ambiguous): {n_unaligned}')
+    logging.info('Reads are counted once per FASTQ file (mate), as separate_reads.py does, '
+                 'but each read name is classified once from all its records')
+
+    df = pd.DataFrame(data={'human': n_human,
+                            'mouse': n_mouse,
+                            'ambiguous': n_ambiguous}, index=[0])
+    df.to_csv(f'{args.out_dir}/{args.out_name}_summary.csv',
+              index=False)
+    logging.info('Done!')
+
+
+if __name__ == "__main__":
+    main()